@@ -0,0 +1,100 @@
+"""Per-item cost of (de)serializing gateway response models.
+
+Compares the per-item pydantic path (json.loads + model_validate for every
+item, jsonable_encoder + json.dumps on the way out) with bulk TypeAdapter
+validate_json/dump_json, and orjson if it's installed.
+
+    python app/bench_json.py [items]
+"""
+
+import json
+import sys
+import timeit
+import uuid
+from datetime import datetime
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from common import *
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_items(n):
+    now = datetime.now()
+    return {
+        "FlightResponse": [
+            FlightResponse(
+                flightNumber=f"AFL{i:04}",
+                fromAirport="Санкт-Петербург Пулково",
+                toAirport="Москва Шереметьево",
+                date=now,
+                price=1500 + i,
+            )
+            for i in range(n)
+        ],
+        "TicketResponse": [
+            TicketResponse(
+                ticketUid=uuid.uuid4(),
+                flightNumber=f"AFL{i:04}",
+                fromAirport="Санкт-Петербург Пулково",
+                toAirport="Москва Шереметьево",
+                date=now,
+                price=1500 + i,
+                status=TicketStatus.PAID,
+            )
+            for i in range(n)
+        ],
+        "BalanceHistory": [
+            BalanceHistory(
+                date=now,
+                ticketUid=uuid.uuid4(),
+                balanceDiff=150,
+                operationType=OperationType.FILL_IN_BALANCE,
+            )
+            for i in range(n)
+        ],
+    }
+
+
+def bench(fn, n, repeat=5):
+    """Best per-item time in microseconds"""
+    number = max(1, 20000 // n)
+    best = min(timeit.repeat(fn, number=number, repeat=repeat))
+    return best / number / n * 1e6
+
+
+def main(n):
+    print(f"{n} items per list, microseconds per item")
+    for name, items in make_items(n).items():
+        model = type(items[0])
+        adapter = TypeAdapter(List[model])
+        raw = adapter.dump_json(items)
+
+        results = {
+            "validate: json.loads + model_validate": lambda: [
+                model.model_validate(x) for x in json.loads(raw)
+            ],
+            "validate: TypeAdapter.validate_json": lambda: adapter.validate_json(raw),
+            "dump: jsonable_encoder + json.dumps": lambda: json.dumps(
+                jsonable_encoder(items)
+            ).encode(),
+            "dump: TypeAdapter.dump_json": lambda: adapter.dump_json(items),
+        }
+        if orjson is not None:
+            results["dump: orjson.dumps(model_dump)"] = lambda: orjson.dumps(
+                [x.model_dump() for x in items]
+            )
+
+        print(name)
+        for label, fn in results.items():
+            print(f"  {label:<40} {bench(fn, n):8.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -1,29 +1,36 @@
 import inspect
 import sys
 import uuid
-from fastapi import FastAPI, HTTPException, Depends, Path
+from fastapi import FastAPI, HTTPException, Depends, Path, Query
 from sqlalchemy import (
     TIMESTAMP,
     CheckConstraint,
     ForeignKey,
+    Index,
     StaticPool,
     create_engine,
     Column,
     Integer,
     String,
     UUID,
+    case,
+    delete,
+    func,
+    select,
+    tuple_,
+    update,
 )
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.orm import declarative_base, relationship
 import os
 
-
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from resilience import abandon_late_requests
 
 if not os.getenv("TESTING"):
     DB_USER = os.getenv("POSTGRES_USER", "postgres")
@@ -85,12 +92,18 @@ class PrivilegeHistoryDb(Base):
             "operation_type IN ('FILL_IN_BALANCE', 'DEBIT_THE_ACCOUNT')",
             name="privilege_operation_type_check",
         ),
+        Index("privilege_history_ticket_idx", "privilege_id", "ticket_uid"),
+        # serves the (datetime, id) keyset pagination of the summary
+        Index("privilege_history_datetime_id_idx", "privilege_id", "datetime", "id"),
     )
 
     privilege = relationship("PrivilegeDb", back_populates="history")
 
 
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "1000"))
+
 app = FastAPI(title="Privilege Service", version="1.0")
+app.middleware("http")(abandon_late_requests)
 
 
 def get_db():
@@ -122,7 +135,46 @@ def get_privilege_history_by_username(username: str, db: Session = Depends(get_d
         .all()
     )
 
-    return history
+    return rows_response(history, PrivilegeHistoryList)
+
+
+@app.get("/privilege/{username}/summary", response_model=PrivilegeWithHistory)
+def get_privilege_with_history(
+    username: str,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Privilege and a page of its history, newest first, read in one
+    transaction. Without limit the whole history is returned"""
+    if db.get_bind().dialect.name == "postgresql":
+        # both queries see the same snapshot
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+    privilege = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
+    if not privilege:
+        raise HTTPException(status_code=404, detail="Privilege not found for this user")
+
+    query = db.query(PrivilegeHistoryDb).filter(
+        PrivilegeHistoryDb.privilege_id == privilege.id
+    )
+    if cursor:
+        query = query.filter(
+            tuple_(PrivilegeHistoryDb.datetime, PrivilegeHistoryDb.id)
+            < tuple_(*decode_cursor(cursor, d=datetime.fromisoformat, i=int))
+        )
+    query = query.order_by(
+        PrivilegeHistoryDb.datetime.desc(), PrivilegeHistoryDb.id.desc()
+    )
+    if limit is None:
+        return PrivilegeWithHistory(privilege=privilege, history=query.all())
+
+    history = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(history) > limit:
+        history = history[:limit]
+        next_cursor = encode_cursor(d=history[-1].datetime, i=history[-1].id)
+    return PrivilegeWithHistory(privilege=privilege, history=history, next=next_cursor)
 
 
 @app.get(
@@ -153,60 +205,96 @@ def get_specific_history_entry(
     return history_entry
 
 
-@app.post("/privilege/{username}/history", status_code=201)
+def privilege_exists(db: Session, username: str) -> bool:
+    return db.query(
+        db.query(PrivilegeDb).filter(PrivilegeDb.username == username).exists()
+    ).scalar()
+
+
+@app.post("/privilege/{username}/history", status_code=201, response_model=Privilege)
 def add_transaction(
     username, data: AddTranscationRequest, db: Session = Depends(get_db)
 ):
-    priv = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
-    if not priv:
-        raise HTTPException(status_code=404, detail="User not found")
-
+    # balance is changed by the UPDATE itself, so concurrent purchases can't
+    # overwrite each other's result; a debit only matches if it's covered
+    balance = func.coalesce(PrivilegeDb.balance, 0)
+    statement = update(PrivilegeDb).where(PrivilegeDb.username == username)
     if data.operation_type == "FILL_IN_BALANCE":
-        priv.balance += data.balance_diff
+        statement = statement.values(balance=balance + data.balance_diff)
     else:
-        if priv.balance < data.balance_diff:
-            raise HTTPException(status_code=409, detail="Can't decrease balance")
-        priv.balance -= data.balance_diff
+        statement = statement.where(balance >= data.balance_diff).values(
+            balance=balance - data.balance_diff
+        )
+    priv = (
+        db.execute(
+            statement.returning(
+                PrivilegeDb.id,
+                PrivilegeDb.username,
+                PrivilegeDb.status,
+                PrivilegeDb.balance,
+            )
+        )
+        .mappings()
+        .first()
+    )
+    if not priv:
+        db.rollback()
+        if not privilege_exists(db, username):
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=409, detail="Can't decrease balance")
 
     hist = PrivilegeHistoryDb(
-        privilege_id=priv.id,
+        privilege_id=priv["id"],
         ticket_uid=data.ticket_uid,
         datetime=data.datetime,
         balance_diff=data.balance_diff,
         operation_type=data.operation_type,
     )
     db.add(hist)
-
     db.commit()
-    db.refresh(priv)
+    return dict(priv)
 
 
 @app.delete("/privilege/{username}/history/{ticket_uid}", status_code=204)
-def rollback_transaction(username, ticket_uid: uuid.UUID, db: Session = Depends(get_db)):
-    priv = db.query(PrivilegeDb).filter(PrivilegeDb.username == username).first()
-    if not priv:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    transaction = (
-        db.query(PrivilegeHistoryDb)
-        .filter(
-            PrivilegeHistoryDb.privilege_id == priv.id,
+def rollback_transaction(
+    username, ticket_uid: uuid.UUID, db: Session = Depends(get_db)
+):
+    # deleting first makes a repeated rollback of the same ticket a no-op
+    # instead of a second refund
+    transactions = db.execute(
+        delete(PrivilegeHistoryDb)
+        .where(
+            PrivilegeHistoryDb.privilege_id
+            == select(PrivilegeDb.id)
+            .where(PrivilegeDb.username == username)
+            .scalar_subquery(),
             PrivilegeHistoryDb.ticket_uid == ticket_uid,
         )
-        .first()
-    )
-    if not transaction:
+        .returning(
+            PrivilegeHistoryDb.privilege_id,
+            PrivilegeHistoryDb.balance_diff,
+            PrivilegeHistoryDb.operation_type,
+        )
+    ).all()
+    if not transactions:
+        db.rollback()
+        if not privilege_exists(db, username):
+            raise HTTPException(status_code=404, detail="User not found")
         raise HTTPException(status_code=404, detail="Transaction not found")
 
-    cur_balance = priv.balance
-    if transaction.operation_type == "FILL_IN_BALANCE":
-        new_balance = max(cur_balance - transaction.balance_diff, 0)
-    else:
-        new_balance = cur_balance + transaction.balance_diff
-    priv.balance = new_balance
-    db.delete(transaction)
+    balance = func.coalesce(PrivilegeDb.balance, 0)
+    for transaction in transactions:
+        diff = transaction.balance_diff
+        if transaction.operation_type == "FILL_IN_BALANCE":
+            new_balance = case((balance > diff, balance - diff), else_=0)
+        else:
+            new_balance = balance + diff
+        db.execute(
+            update(PrivilegeDb)
+            .where(PrivilegeDb.id == transaction.privilege_id)
+            .values(balance=new_balance)
+        )
     db.commit()
-    db.refresh(priv)
 
 
 @app.get("/manage/health", status_code=201)
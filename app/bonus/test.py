@@ -2,12 +2,15 @@ from datetime import datetime
 from uuid import uuid4
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import tuple_
 from sqlalchemy.orm import sessionmaker
 import os
 
 os.environ["TESTING"] = "True"
 
 from main import app, get_db, Base, PrivilegeDb, PrivilegeHistoryDb, engine
+from testing import query_plan
+import common
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -42,6 +45,11 @@ def client():
     Base.metadata.drop_all(bind=engine)
 
 
+@pytest.fixture(params=[False, True], ids=["response_model", "fast_json"])
+def fast_json(request, monkeypatch):
+    monkeypatch.setattr(common, "FAST_JSON", request.param)
+
+
 @pytest.fixture
 def sample_privilege(db_session):
     privilege = PrivilegeDb(username="api_user", status="BRONZE", balance=100)
@@ -84,7 +92,7 @@ def test_get_privilege_not_found(client):
 # GET /privilege/{username}/history
 
 
-def test_get_privilege_history_list(client, sample_privilege):
+def test_get_privilege_history_list(client, sample_privilege, fast_json):
     privilege, history = sample_privilege
 
     response = client.get(f"/privilege/{privilege.username}/history")
@@ -119,6 +127,37 @@ def test_get_specific_history_not_found(client, sample_privilege):
     assert response.status_code == 404
 
 
+def test_history_queries_use_indexes(db_session):
+    query = db_session.query(PrivilegeHistoryDb).filter(
+        PrivilegeHistoryDb.privilege_id == 1,
+        PrivilegeHistoryDb.ticket_uid == uuid4(),
+    )
+    assert "USING INDEX privilege_history_ticket_idx" in query_plan(db_session, query)
+
+    query = (
+        db_session.query(PrivilegeHistoryDb)
+        .filter(PrivilegeHistoryDb.privilege_id == 1)
+        .order_by(PrivilegeHistoryDb.datetime.desc())
+    )
+    plan = query_plan(db_session, query)
+    assert "USING INDEX privilege_history_datetime_id_idx" in plan
+    assert "TEMP B-TREE" not in plan
+
+    # a summary page after a cursor
+    query = (
+        db_session.query(PrivilegeHistoryDb)
+        .filter(
+            PrivilegeHistoryDb.privilege_id == 1,
+            tuple_(PrivilegeHistoryDb.datetime, PrivilegeHistoryDb.id)
+            < tuple_(datetime(2021, 10, 8), 10),
+        )
+        .order_by(PrivilegeHistoryDb.datetime.desc(), PrivilegeHistoryDb.id.desc())
+    )
+    plan = query_plan(db_session, query)
+    assert "USING INDEX privilege_history_datetime_id_idx" in plan
+    assert "TEMP B-TREE" not in plan
+
+
 # POST /privilege/{username}/history
 
 
@@ -136,6 +175,8 @@ def test_create_privilege_history(client, sample_privilege):
 
     response = client.post(f"/privilege/{privilege.username}/history", json=payload)
     assert response.status_code == 201
+    assert response.json()["balance"] == 50
+    assert response.json()["status"] == "BRONZE"
 
     check_privilege = client.get(f"/privilege/{privilege.username}")
     assert check_privilege.status_code == 200
@@ -155,6 +196,66 @@ def test_create_privilege_history_invalid_type(client, sample_privilege):
     assert response.status_code == 400 or response.status_code == 422
 
 
+def test_create_privilege_history_overdraft(client, sample_privilege):
+    privilege, _ = sample_privilege
+    payload = {
+        "ticket_uid": str(uuid4()),
+        "balance_diff": 150,
+        "operation_type": "DEBIT_THE_ACCOUNT",
+        "privilege_id": privilege.id,
+        "datetime": datetime.now().isoformat(),
+    }
+
+    response = client.post(f"/privilege/{privilege.username}/history", json=payload)
+    assert response.status_code == 409
+    response = client.post("/privilege/nobody/history", json=payload)
+    assert response.status_code == 404
+
+    assert client.get(f"/privilege/{privilege.username}").json()["balance"] == 100
+    history = client.get(f"/privilege/{privilege.username}/history").json()
+    assert len(history) == 1
+
+
+def test_get_privilege_with_history(client, sample_privilege, db_session, fast_json):
+    privilege, _ = sample_privilege
+    for day in range(1, 6):
+        db_session.add(
+            PrivilegeHistoryDb(
+                privilege_id=privilege.id,
+                ticket_uid=uuid4(),
+                datetime=datetime(2024, 1, day),
+                balance_diff=day,
+                operation_type="FILL_IN_BALANCE",
+            )
+        )
+    db_session.commit()
+
+    response = client.get(f"/privilege/{privilege.username}/summary")
+    assert response.status_code == 200
+    assert response.json()["privilege"]["balance"] == 100
+    assert len(response.json()["history"]) == 6
+    assert response.json()["next"] is None
+
+    seen = []
+    params = {"limit": 2}
+    while True:
+        data = client.get(f"/privilege/{privilege.username}/summary", params=params)
+        data = data.json()
+        assert len(data["history"]) <= 2
+        seen += [x["balance_diff"] for x in data["history"]]
+        if data["next"] is None:
+            break
+        params["cursor"] = data["next"]
+    assert seen == [100, 5, 4, 3, 2, 1]
+
+    response = client.get("/privilege/nobody/summary")
+    assert response.status_code == 404
+    response = client.get(
+        f"/privilege/{privilege.username}/summary", params={"cursor": "garbage"}
+    )
+    assert response.status_code == 400
+
+
 # DELETE /privilege/{username}/history/{ticket_uid}
 
 
@@ -170,6 +271,15 @@ def test_delete_privilege_history(client, sample_privilege):
     assert check.status_code == 404
 
 
+def test_delete_privilege_history_only_once(client, sample_privilege):
+    privilege, history = sample_privilege
+    url = f"/privilege/{privilege.username}/history/{history.ticket_uid}"
+
+    assert client.delete(url).status_code == 204
+    assert client.delete(url).status_code == 404
+    assert client.get(f"/privilege/{privilege.username}").json()["balance"] == 0
+
+
 def test_delete_nonexistent_history(client, sample_privilege):
     privilege, _ = sample_privilege
     response = client.delete(f"/privilege/{privilege.username}/history/{uuid4()}")
@@ -2,10 +2,17 @@ import uuid
 from pydantic import BaseModel
 from typing import List, Optional
 import datetime
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
 from typing import List
 from datetime import datetime
 from enum import Enum
+from fastapi import HTTPException, Response
+import base64
+import json
+import os
+
+# serialize validated response models directly, bypassing response_model
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() == "true"
 
 
 class Ticket(BaseModel):
@@ -64,6 +71,30 @@ class TicketStatus(str, Enum):
     CANCELED = "CANCELED"
 
 
+# keyset pagination of lists with a fixed response shape: cursor of the next
+# page, absent on the last one
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(**key) -> str:
+    """Opaque keyset cursor holding the sort key of the last row of a page"""
+    data = {
+        name: value.isoformat() if isinstance(value, datetime) else value
+        for name, value in key.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor: str, **types) -> tuple:
+    """Key values of a cursor made by encode_cursor, in the order of types,
+    each parsed with its type. 400 if the cursor is malformed"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return tuple(parse(data[name]) for name, parse in types.items())
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 class PrivilegeStatus(str, Enum):
     BRONZE = "BRONZE"
     SILVER = "SILVER"
@@ -90,6 +121,7 @@ class PaginationResponse(BaseModel):
     pageSize: int = Field(..., description="Количество элементов на странице")
     totalElements: int = Field(..., description="Общее количество элементов")
     items: List[FlightResponse] = Field(..., description="Список рейсов")
+    next: Optional[str] = Field(None, description="Курсор следующей страницы")
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -106,6 +138,15 @@ class TicketResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class FlightSalesResponse(BaseModel):
+    flightNumber: str = Field(..., description="Номер полета")
+    status: TicketStatus = Field(..., description="Статус билетов")
+    tickets: int = Field(..., description="Количество билетов")
+    revenue: int = Field(..., description="Суммарная стоимость билетов")
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class PrivilegeShortInfo(BaseModel):
     balance: int = Field(..., description="Баланс бонусного счета")
     status: PrivilegeStatus = Field(..., description="Статус в бонусной программе")
@@ -193,6 +234,45 @@ class AddTranscationRequest(BaseModel):
     operation_type: str
 
 
+class TicketPage(BaseModel):
+    items: List[Ticket]
+    next: Optional[str] = None
+
+
+class PrivilegeWithHistory(BaseModel):
+    privilege: Privilege
+    history: List[PrivilegeHistory]
+    next: Optional[str] = None
+
+
+# Bulk (de)serialization of lists in one pydantic-core call, validate_json
+# parses bytes directly without building intermediate dicts
+TicketList = TypeAdapter(List[Ticket])
+PrivilegeHistoryList = TypeAdapter(List[PrivilegeHistory])
+FlightResponseList = TypeAdapter(List[FlightResponse])
+TicketResponseList = TypeAdapter(List[TicketResponse])
+
+
+def model_response(value, adapter: TypeAdapter = None, headers: dict = None):
+    """With FAST_JSON serialize already validated models to JSON bytes in one
+    pydantic-core call instead of letting FastAPI re-validate them"""
+    if not FAST_JSON:
+        return value
+    if adapter is None:
+        content = value.model_dump_json()
+    else:
+        content = adapter.dump_json(value)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+def rows_response(rows, adapter: TypeAdapter, headers: dict = None):
+    """model_response for ORM rows, validated with one adapter call"""
+    if not FAST_JSON:
+        return rows
+    models = adapter.validate_python(rows, from_attributes=True)
+    return model_response(models, adapter, headers)
+
+
 # Request/Response Models
 class TokenRequest(BaseModel):
     username: str
@@ -221,3 +301,4 @@ class JWTClaims(BaseModel):
     scope: Optional[str] = None
     email: Optional[str] = None
     name: Optional[str] = None
+    preferred_username: Optional[str] = None
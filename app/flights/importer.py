@@ -0,0 +1,228 @@
+"""Bulk import of airports and flights.
+
+Input is CSV (with a header row) or NDJSON, one record per row, read as a
+stream. On PostgreSQL rows are loaded with COPY, otherwise (sqlite in test
+mode) with batched INSERTs. Flights reference airports by name, so airports
+whose name is already in the table are skipped.
+
+    python app/flights/importer.py airports airports.csv
+    python app/flights/importer.py flights schedule.ndjson
+    cat schedule.csv | python app/flights/importer.py flights - --format csv
+
+airports: name, city, country
+flights:  flight_number, datetime (ISO 8601), from_airport, to_airport, price
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Iterable, Iterator, TextIO
+
+from pydantic import BaseModel
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from main import AirportDb, FlightDb
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+IMPORT_COPY_CHUNK = int(os.getenv("IMPORT_COPY_CHUNK", str(1 << 16)))
+
+AIRPORT_COLUMNS = ("name", "city", "country")
+FLIGHT_COLUMNS = (
+    "flight_number",
+    "datetime",
+    "from_airport_id",
+    "to_airport_id",
+    "price",
+)
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+class ImportStats(BaseModel):
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+    def __str__(self):
+        return (
+            f"{self.rows} rows in {self.seconds:.2f}s "
+            f"({self.rows_per_second:.0f} rows/s)"
+        )
+
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[tuple[int, dict]]:
+    """(line number, record) pairs from a CSV or NDJSON stream"""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line_num, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield line_num, json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise BulkImportError(f"line {line_num}: {e}")
+    else:
+        raise BulkImportError(f"unknown format {fmt}")
+
+
+def airport_rows(
+    records: Iterable[tuple[int, dict]], known_names: set[str]
+) -> Iterator[tuple]:
+    """Rows of airports not in known_names. Flights refer to airports by
+    name, so a name is imported once and re-running an import is a no-op"""
+    for line_num, record in records:
+        if not record.get("name"):
+            raise BulkImportError(f"line {line_num}: airport name is required")
+        if record["name"] in known_names:
+            continue
+        known_names.add(record["name"])
+        yield tuple(record.get(column) for column in AIRPORT_COLUMNS)
+
+
+def flight_rows(
+    records: Iterable[tuple[int, dict]], airport_ids: dict[str, int]
+) -> Iterator[tuple]:
+    for line_num, record in records:
+        try:
+            row = (
+                record["flight_number"],
+                datetime.fromisoformat(record["datetime"]),
+                airport_ids[record["from_airport"]],
+                airport_ids[record["to_airport"]],
+                int(record["price"]),
+            )
+            if None in row[2:4]:
+                raise ValueError("several airports have this name")
+            yield row
+        except KeyError as e:
+            raise BulkImportError(f"line {line_num}: unknown airport or field {e}")
+        except (TypeError, ValueError) as e:
+            raise BulkImportError(f"line {line_num}: {e}")
+
+
+class CsvStream:
+    """File-like object that renders rows as CSV on demand, so COPY never
+    needs the whole input in memory"""
+
+    def __init__(self, rows: Iterable[tuple]):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.count = 0
+        self.error = None
+
+    def read(self, size: int = -1) -> str:
+        size = size if size > 0 else IMPORT_COPY_CHUNK
+        try:
+            for row in self.rows:
+                self.writer.writerow(
+                    value.isoformat() if isinstance(value, datetime) else value
+                    for value in row
+                )
+                self.count += 1
+                if self.buffer.tell() >= size:
+                    break
+        except BulkImportError as e:
+            # psycopg2 turns errors raised here into QueryCanceled, the
+            # original is kept for copy_rows to report
+            self.error = e
+            raise
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def copy_rows(db: Session, table, columns: tuple, rows: Iterable[tuple]) -> int:
+    """Load rows into table within the session transaction, returns row count"""
+    connection = db.connection()
+    if connection.dialect.name == "postgresql":
+        stream = CsvStream(rows)
+        try:
+            with connection.connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                    stream,
+                )
+        except Exception:
+            if stream.error is not None:
+                raise stream.error
+            raise
+        return stream.count
+
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(dict(zip(columns, row)))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            db.execute(insert(table), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.execute(insert(table), batch)
+        count += len(batch)
+    return count
+
+
+def import_airports(db: Session, stream: TextIO, fmt: str) -> ImportStats:
+    started = time.perf_counter()
+    known_names = {name for (name,) in db.query(AirportDb.name)}
+    rows = airport_rows(read_records(stream, fmt), known_names)
+    count = copy_rows(db, AirportDb.__table__, AIRPORT_COLUMNS, rows)
+    db.commit()
+    return ImportStats(rows=count, seconds=time.perf_counter() - started)
+
+
+def import_flights(db: Session, stream: TextIO, fmt: str) -> ImportStats:
+    started = time.perf_counter()
+    airport_ids = {}
+    for airport_id, name in db.query(AirportDb.id, AirportDb.name):
+        # a duplicated name can't be resolved, flights using it are rejected
+        airport_ids[name] = None if name in airport_ids else airport_id
+
+    rows = flight_rows(read_records(stream, fmt), airport_ids)
+    count = copy_rows(db, FlightDb.__table__, FLIGHT_COLUMNS, rows)
+    db.commit()
+    return ImportStats(rows=count, seconds=time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import of flights data")
+    parser.add_argument("kind", choices=["airports", "flights"])
+    parser.add_argument("file", help="input file, - for stdin")
+    parser.add_argument("--format", choices=["csv", "ndjson"])
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.file.endswith(".csv") else "ndjson"
+
+    from main import SessionLocal
+
+    importer = import_airports if args.kind == "airports" else import_flights
+    stream = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+    with stream, SessionLocal() as db:
+        try:
+            stats = importer(db, stream, fmt)
+        except (BulkImportError, DBAPIError) as e:
+            db.rollback()
+            sys.exit(f"Import failed, nothing was loaded: {e}")
+    print(f"Imported {args.kind}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
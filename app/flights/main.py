@@ -1,18 +1,26 @@
 import inspect
 import sys
 from fastapi import FastAPI, HTTPException, Depends, Query
+from typing import Literal
 from sqlalchemy import create_engine, Column, Integer, String
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
 from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, StaticPool
+from sqlalchemy import Index, func, text, tuple_
 from sqlalchemy.orm import relationship, declarative_base
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
 from datetime import datetime
+from types import MappingProxyType
+import logging
 import os
+import threading
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from resilience import abandon_late_requests
 
 if not os.getenv("TESTING"):
     DB_USER = os.getenv("POSTGRES_USER", "postgres")
@@ -37,7 +45,25 @@ else:
         poolclass=StaticPool,
     )
 
-app = FastAPI(title="Flight API")
+logger = logging.getLogger(f"uvicorn.{__name__}")
+
+FLIGHTS_BATCH_LIMIT = int(os.getenv("FLIGHTS_BATCH_LIMIT", "500"))
+AIRPORTS_REFRESH_INTERVAL = float(os.getenv("AIRPORTS_REFRESH_INTERVAL", "300"))
+FLIGHTS_COUNT_TTL = float(os.getenv("FLIGHTS_COUNT_TTL", "30"))
+# above this many rows (by planner statistics) totalElements is estimated
+FLIGHTS_EXACT_COUNT_LIMIT = int(os.getenv("FLIGHTS_EXACT_COUNT_LIMIT", "100000"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not os.getenv("TESTING"):
+        airport_directory.start(SessionLocal)
+    yield
+    airport_directory.stop()
+
+
+app = FastAPI(title="Flight API", lifespan=lifespan)
+app.middleware("http")(abandon_late_requests)
 
 
 def get_db():
@@ -76,6 +102,15 @@ class FlightDb(Base):
     to_airport_id = Column(Integer, ForeignKey("airport.id"))
     price = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index("flight_flight_number_idx", "flight_number", unique=True),
+        Index("flight_datetime_id_idx", "datetime", "id"),
+        Index(
+            "flight_route_datetime_idx", "from_airport_id", "to_airport_id", "datetime"
+        ),
+        Index("flight_route_price_idx", "from_airport_id", "to_airport_id", "price"),
+    )
+
     from_airport = relationship(
         "AirportDb", foreign_keys=[from_airport_id], back_populates="departures"
     )
@@ -84,39 +119,275 @@ class FlightDb(Base):
     )
 
 
-def flight_to_response(flight: FlightDb) -> FlightResponse:
-    from_airport = f"{flight.from_airport.city} {flight.from_airport.name}"
-    to_airport = f"{flight.to_airport.city} {flight.to_airport.name}"
+class AirportDirectory:
+    """Immutable in-process id -> Airport map. The airport table is tiny and
+    effectively static, so flight responses are built without touching it.
+    The map is reloaded periodically in background, on demand, and when a
+    flight references an airport it doesn't know yet. Ids still missing
+    after that are remembered and not looked up again until the next refresh"""
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.airports = MappingProxyType({})
+        self.missing = frozenset()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.refresher = None
+
+    def refresh(self, db: Session) -> int:
+        count = self._load(db)
+        self.missing = frozenset()
+        return count
+
+    def _load(self, db: Session) -> int:
+        airports = {
+            airport.id: Airport.model_validate(airport)
+            for airport in db.query(AirportDb).all()
+        }
+        # swap the whole map, readers never see a partial one
+        self.airports = MappingProxyType(airports)
+        return len(airports)
+
+    def get(self, db: Session, airport_id: int) -> Airport:
+        airport = self.airports.get(airport_id)
+        if airport is None and airport_id not in self.missing:
+            with self.lock:
+                if airport_id not in self.airports and airport_id not in self.missing:
+                    self._load(db)
+                    if airport_id not in self.airports:
+                        self.missing = self.missing | {airport_id}
+            airport = self.airports.get(airport_id)
+        if airport is None:
+            logger.error(f"Airport {airport_id} is missing from the airport table")
+            raise HTTPException(
+                status_code=500, detail=f"Airport {airport_id} not found"
+            )
+        return airport
+
+    def find(self, db: Session, name: Optional[str], city: Optional[str]):
+        """Ids of airports matching the given name and city"""
+        if not self.airports:
+            with self.lock:
+                if not self.airports:
+                    self.refresh(db)
+        return [
+            airport.id
+            for airport in self.airports.values()
+            if (name is None or airport.name == name)
+            and (city is None or airport.city == city)
+        ]
+
+    def invalidate(self):
+        self.airports = MappingProxyType({})
+        self.missing = frozenset()
+
+    def start(self, session_factory):
+        if self.refresher is not None:
+            return
+        self.stop_event.clear()
+        self.refresher = threading.Thread(
+            target=self._refresh_loop,
+            args=(session_factory,),
+            name="airports-refresher",
+            daemon=True,
+        )
+        self.refresher.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.refresher is not None:
+            self.refresher.join(timeout=1)
+            self.refresher = None
+
+    def _refresh_loop(self, session_factory):
+        while True:
+            try:
+                with session_factory() as db:
+                    count = self.refresh(db)
+                logger.info(f"Loaded {count} airports")
+            except Exception as e:
+                logger.warning(f"Failed to load airports: {e}")
+            if self.stop_event.wait(self.refresh_interval):
+                return
+
+
+airport_directory = AirportDirectory(AIRPORTS_REFRESH_INTERVAL)
+
+
+def flight_to_response(flight: FlightDb, db: Session) -> FlightResponse:
+    from_airport = airport_directory.get(db, flight.from_airport_id)
+    to_airport = airport_directory.get(db, flight.to_airport_id)
 
     return FlightResponse(
         flightNumber=flight.flight_number,
-        fromAirport=from_airport,
-        toAirport=to_airport,
+        fromAirport=f"{from_airport.city} {from_airport.name}",
+        toAirport=f"{to_airport.city} {to_airport.name}",
         date=flight.datetime.isoformat(),
         price=flight.price,
     )
 
 
+flights_count_cache = TTLCache(maxsize=1, ttl=FLIGHTS_COUNT_TTL)
+flights_count_lock = threading.Lock()
+
+
+def count_flights(db: Session) -> int:
+    """Number of flights, cached for FLIGHTS_COUNT_TTL. On big PostgreSQL
+    tables the planner estimate is used instead of a full scan"""
+    with flights_count_lock:
+        total = flights_count_cache.get("total")
+    if total is not None:
+        return total
+
+    total = None
+    if db.bind.dialect.name == "postgresql":
+        estimate = db.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'flight'")
+        ).scalar()
+        if estimate is not None and estimate > FLIGHTS_EXACT_COUNT_LIMIT:
+            total = estimate
+    if total is None:
+        total = db.query(func.count(FlightDb.id)).scalar()
+
+    with flights_count_lock:
+        flights_count_cache["total"] = total
+    return total
+
+
 @app.get("/flights", response_model=PaginationResponse)
 def get_all_flights(
+    page: int = Query(1, ge=1, description="Номер страницы"),
+    page_size: int = Query(
+        10, ge=1, le=100, description="Количество элементов на странице"
+    ),
+    cursor: Optional[str] = Query(
+        None,
+        description="Курсор следующей страницы, пустой для первой страницы. "
+        "В этом режиме рейсы упорядочены по дате",
+    ),
+    db: Session = Depends(get_db),
+):
+    if cursor is None:
+        offset = (page - 1) * page_size
+        flights = (
+            db.query(FlightDb)
+            .order_by(FlightDb.id)
+            .offset(offset)
+            .limit(page_size)
+            .all()
+        )
+        next_cursor = None
+    else:
+        query = db.query(FlightDb)
+        if cursor:
+            after_datetime, after_id, page = decode_cursor(
+                cursor, d=datetime.fromisoformat, i=int, p=int
+            )
+            query = query.filter(
+                tuple_(FlightDb.datetime, FlightDb.id) > (after_datetime, after_id)
+            )
+        else:
+            page = 1
+        flights = (
+            query.order_by(FlightDb.datetime, FlightDb.id).limit(page_size + 1).all()
+        )
+        next_cursor = None
+        if len(flights) > page_size:
+            flights = flights[:page_size]
+            next_cursor = encode_cursor(
+                d=flights[-1].datetime, i=flights[-1].id, p=page + 1
+            )
+
+    response_items = [flight_to_response(f, db) for f in flights]
+
+    return model_response(
+        PaginationResponse(
+            page=page,
+            pageSize=page_size,
+            totalElements=count_flights(db),
+            items=response_items,
+            next=next_cursor,
+        )
+    )
+
+
+@app.get("/flights/search", response_model=PaginationResponse)
+def search_flights(
+    from_airport: Optional[str] = Query(None, description="Аэропорт отправления"),
+    from_city: Optional[str] = Query(None, description="Город отправления"),
+    to_airport: Optional[str] = Query(None, description="Аэропорт прибытия"),
+    to_city: Optional[str] = Query(None, description="Город прибытия"),
+    date_from: Optional[datetime] = Query(None, description="Вылет не раньше"),
+    date_to: Optional[datetime] = Query(None, description="Вылет не позже"),
+    price_min: Optional[int] = Query(None, ge=0, description="Минимальная цена"),
+    price_max: Optional[int] = Query(None, ge=0, description="Максимальная цена"),
+    sort_by: Literal["date", "price"] = Query("date", description="Сортировка"),
+    order: Literal["asc", "desc"] = Query("asc", description="Порядок сортировки"),
     page: int = Query(1, ge=1, description="Номер страницы"),
     page_size: int = Query(
         10, ge=1, le=100, description="Количество элементов на странице"
     ),
     db: Session = Depends(get_db),
 ):
-    offset = (page - 1) * page_size
+    query = db.query(FlightDb)
+    if from_airport is not None or from_city is not None:
+        query = query.filter(
+            FlightDb.from_airport_id.in_(
+                airport_directory.find(db, from_airport, from_city)
+            )
+        )
+    if to_airport is not None or to_city is not None:
+        query = query.filter(
+            FlightDb.to_airport_id.in_(airport_directory.find(db, to_airport, to_city))
+        )
+    if date_from is not None:
+        query = query.filter(FlightDb.datetime >= date_from)
+    if date_to is not None:
+        query = query.filter(FlightDb.datetime <= date_to)
+    if price_min is not None:
+        query = query.filter(FlightDb.price >= price_min)
+    if price_max is not None:
+        query = query.filter(FlightDb.price <= price_max)
+
+    total = query.with_entities(func.count(FlightDb.id)).scalar()
+
+    sort_column = FlightDb.datetime if sort_by == "date" else FlightDb.price
+    if order == "desc":
+        ordering = (sort_column.desc(), FlightDb.id.desc())
+    else:
+        ordering = (sort_column.asc(), FlightDb.id.asc())
+    flights = (
+        query.order_by(*ordering).offset((page - 1) * page_size).limit(page_size).all()
+    )
 
-    total = db.query(FlightDb).count()
-    flights = db.query(FlightDb).offset(offset).limit(page_size).all()
+    return model_response(
+        PaginationResponse(
+            page=page,
+            pageSize=page_size,
+            totalElements=total,
+            items=[flight_to_response(f, db) for f in flights],
+        )
+    )
 
-    response_items = [flight_to_response(f) for f in flights]
 
-    return PaginationResponse(
-        page=page,
-        pageSize=page_size,
-        totalElements=total,
-        items=response_items,
+@app.get("/flights/batch", response_model=List[FlightResponse])
+def get_flights_by_numbers(
+    numbers: List[str] = Query(..., description="Номера рейсов"),
+    db: Session = Depends(get_db),
+):
+    # accept both ?numbers=A&numbers=B and ?numbers=A,B
+    flight_numbers = {n for item in numbers for n in item.split(",") if n}
+    if len(flight_numbers) > FLIGHTS_BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many flight numbers, max is {FLIGHTS_BATCH_LIMIT}",
+        )
+
+    flights = (
+        db.query(FlightDb).filter(FlightDb.flight_number.in_(flight_numbers)).all()
+    )
+    return model_response(
+        [flight_to_response(f, db) for f in flights], FlightResponseList
     )
 
 
@@ -127,7 +398,12 @@ def get_flight_by_number(flight_number: str, db: Session = Depends(get_db)):
     if not flight:
         raise HTTPException(status_code=404, detail="Flight not found")
 
-    return flight_to_response(flight)
+    return flight_to_response(flight, db)
+
+
+@app.post("/manage/airports/refresh")
+def refresh_airports(db: Session = Depends(get_db)):
+    return {"airports": airport_directory.refresh(db)}
 
 
 @app.get("/manage/health", status_code=201)
@@ -1,12 +1,24 @@
 from datetime import datetime
+import io
+import json
+import time
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 import os
 
 os.environ["TESTING"] = "True"
+os.environ["FLIGHTS_COUNT_TTL"] = "0"
 
-from main import app, get_db, Base, FlightDb, AirportDb, engine
+from main import app, get_db, Base, FlightDb, AirportDb, engine, airport_directory
+from testing import query_plan
+from importer import import_airports, import_flights, BulkImportError
+from importer import copy_rows, flight_rows, read_records
+import common
+from psycopg2.errors import QueryCanceled
+from types import SimpleNamespace
+import importer
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -32,6 +44,7 @@ def db_session():
     finally:
         session.close()
         Base.metadata.drop_all(bind=engine)
+        airport_directory.invalidate()
 
 
 @pytest.fixture
@@ -39,6 +52,12 @@ def client():
     Base.metadata.create_all(bind=engine)
     yield TestClient(app)
     Base.metadata.drop_all(bind=engine)
+    airport_directory.invalidate()
+
+
+@pytest.fixture(params=[False, True], ids=["response_model", "fast_json"])
+def fast_json(request, monkeypatch):
+    monkeypatch.setattr(common, "FAST_JSON", request.param)
 
 
 @pytest.fixture
@@ -60,7 +79,40 @@ def sample_data(db_session):
     return airport1, airport2, flight
 
 
-def test_get_flights(client, sample_data):
+@pytest.fixture
+def many_flights(db_session):
+    airports = [
+        AirportDb(name=f"Аэропорт {i}", city=f"Город {i}", country="Россия")
+        for i in range(10)
+    ]
+    db_session.add_all(airports)
+    db_session.commit()
+    for i in range(20):
+        db_session.add(
+            FlightDb(
+                flight_number=f"SU{i:03}",
+                datetime=datetime.now(),
+                from_airport_id=airports[i % 10].id,
+                to_airport_id=airports[(i + 1) % 10].id,
+                price=1000 + i,
+            )
+        )
+    db_session.commit()
+
+
+@pytest.fixture
+def query_counter():
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    yield statements
+    event.remove(engine, "before_cursor_execute", count)
+
+
+def test_get_flights(client, sample_data, fast_json):
     _, _, flight = sample_data
 
     response = client.get(f"/flights")
@@ -86,5 +138,311 @@ def test_get_flight(client, sample_data):
     assert data["toAirport"] == "Санкт-Петербург Пулково"
 
 
+def test_flight_lookup_uses_index(db_session):
+    query = db_session.query(FlightDb).filter(FlightDb.flight_number == "AFL031")
+    assert "USING INDEX flight_flight_number_idx" in query_plan(db_session, query)
+
+
+def test_get_flights_batch(client, sample_data, fast_json):
+    _, _, flight = sample_data
+
+    response = client.get(
+        "/flights/batch", params={"numbers": [flight.flight_number, "UNKNOWN"]}
+    )
+    assert response.status_code == 200
+
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["flightNumber"] == flight.flight_number
+    assert data[0]["fromAirport"] == "Москва Шереметьево"
+
+    response = client.get(f"/flights/batch?numbers={flight.flight_number},UNKNOWN")
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+
+
+def test_flights_query_count(client, many_flights, query_counter):
+    assert client.post("/manage/airports/refresh").json() == {"airports": 10}
+    query_counter.clear()
+
+    response = client.get("/flights", params={"page_size": 20})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["items"]) == 20
+    assert data["items"][3]["fromAirport"] == "Город 3 Аэропорт 3"
+    assert data["items"][3]["toAirport"] == "Город 4 Аэропорт 4"
+    # count + page
+    assert len(query_counter) == 2
+
+    query_counter.clear()
+    response = client.get(
+        "/flights/batch", params={"numbers": [f"SU{i:03}" for i in range(20)]}
+    )
+    assert len(response.json()) == 20
+    assert len(query_counter) == 1
+
+    query_counter.clear()
+    response = client.get("/flights/SU005")
+    assert response.json()["fromAirport"] == "Город 5 Аэропорт 5"
+    assert len(query_counter) == 1
+    assert not any("FROM airport" in q for q in query_counter)
+
+
+def test_unknown_airport_reloads_directory(client, sample_data, db_session):
+    airport1, _, _ = sample_data
+    assert client.get("/flights/AFL031").status_code == 200
+
+    airport3 = AirportDb(name="Кольцово", city="Екатеринбург", country="Россия")
+    db_session.add(airport3)
+    db_session.commit()
+    db_session.add(
+        FlightDb(
+            flight_number="AFL032",
+            datetime=datetime.now(),
+            from_airport_id=airport1.id,
+            to_airport_id=airport3.id,
+            price=2000,
+        )
+    )
+    db_session.commit()
+
+    response = client.get("/flights/AFL032")
+    assert response.status_code == 200
+    assert response.json()["toAirport"] == "Екатеринбург Кольцово"
+
+
+def test_missing_airport_is_not_reloaded(
+    client, sample_data, db_session, query_counter
+):
+    airport1, _, _ = sample_data
+    db_session.add(
+        FlightDb(
+            flight_number="AFL404",
+            datetime=datetime.now(),
+            from_airport_id=airport1.id,
+            to_airport_id=404,
+            price=2000,
+        )
+    )
+    db_session.commit()
+
+    for _ in range(3):
+        response = client.get("/flights/AFL404")
+        assert response.status_code == 500
+        assert response.json()["detail"] == "Airport 404 not found"
+        loads = [q for q in query_counter if "FROM airport" in q]
+        query_counter.clear()
+    # only the first request looked the airport up
+    assert loads == []
+
+    # until the next refresh
+    assert client.post("/manage/airports/refresh").status_code == 200
+    client.get("/flights/AFL404")
+    assert sum("FROM airport" in q for q in query_counter) == 2
+
+
+def test_get_flights_cursor(client, many_flights, fast_json):
+    seen = []
+    cursor = ""
+    page = 0
+    while cursor is not None:
+        response = client.get("/flights", params={"cursor": cursor, "page_size": 6})
+        assert response.status_code == 200
+        data = response.json()
+        page += 1
+        assert data["page"] == page
+        assert data["totalElements"] == 20
+        seen += [item["flightNumber"] for item in data["items"]]
+        cursor = data["next"]
+
+    assert page == 4
+    assert seen == [f"SU{i:03}" for i in range(20)]
+
+
+def test_get_flights_invalid_cursor(client, many_flights):
+    response = client.get("/flights", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+
+def test_search_flights(client, many_flights, fast_json):
+    response = client.get("/flights/search", params={"from_city": "Город 3"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["totalElements"] == 2
+    assert [x["flightNumber"] for x in data["items"]] == ["SU003", "SU013"]
+
+    response = client.get(
+        "/flights/search",
+        params={
+            "to_airport": "Аэропорт 4",
+            "from_city": "Город 3",
+            "price_min": 1010,
+        },
+    )
+    data = response.json()
+    assert [x["flightNumber"] for x in data["items"]] == ["SU013"]
+
+    response = client.get(
+        "/flights/search",
+        params={"price_max": 1004, "sort_by": "price", "order": "desc", "page_size": 2},
+    )
+    data = response.json()
+    assert data["totalElements"] == 5
+    assert [x["flightNumber"] for x in data["items"]] == ["SU004", "SU003"]
+
+
+def test_late_request_is_dropped(client, sample_data):
+    _, _, flight = sample_data
+
+    response = client.get(
+        f"/flights/{flight.flight_number}",
+        headers={"X-Request-Deadline": str(time.time() - 1)},
+    )
+    assert response.status_code == 504
+
+    response = client.get(
+        f"/flights/{flight.flight_number}",
+        headers={"X-Request-Deadline": str(time.time() + 10)},
+    )
+    assert response.status_code == 200
+
+
+def test_bulk_import(client, db_session):
+    airports = io.StringIO(
+        "name,city,country\n"
+        "Шереметьево,Москва,Россия\n"
+        "Пулково,Санкт-Петербург,Россия\n"
+    )
+    assert import_airports(db_session, airports, "csv").rows == 2
+
+    flights = io.StringIO(
+        "".join(
+            json.dumps(
+                {
+                    "flight_number": f"AFL{i:03}",
+                    "datetime": f"2021-10-08T20:{i:02}:00",
+                    "from_airport": "Пулково",
+                    "to_airport": "Шереметьево",
+                    "price": 1500 + i,
+                }
+            )
+            + "\n"
+            for i in range(30)
+        )
+    )
+    stats = import_flights(db_session, flights, "ndjson")
+    assert stats.rows == 30
+    assert stats.rows_per_second > 0
+
+    response = client.get("/flights/AFL007")
+    assert response.status_code == 200
+    assert response.json()["fromAirport"] == "Санкт-Петербург Пулково"
+    assert response.json()["price"] == 1507
+
+
+def test_bulk_import_unknown_airport(db_session):
+    flights = io.StringIO(
+        "flight_number,datetime,from_airport,to_airport,price\n"
+        "AFL001,2021-10-08 20:00,Пулково,Кольцово,1500\n"
+    )
+    with pytest.raises(BulkImportError, match="line 2"):
+        import_flights(db_session, flights, "csv")
+    db_session.rollback()
+    assert db_session.query(FlightDb).count() == 0
+
+
+def test_bulk_import_airports_twice(db_session):
+    airports = "name,city,country\nПулково,Санкт-Петербург,Россия\n"
+    assert import_airports(db_session, io.StringIO(airports), "csv").rows == 1
+    assert import_airports(db_session, io.StringIO(airports), "csv").rows == 0
+    assert db_session.query(AirportDb).count() == 1
+
+
+def test_bulk_import_ambiguous_airport(db_session):
+    db_session.add_all(
+        [
+            AirportDb(name="Пулково", city="Санкт-Петербург", country="Россия"),
+            AirportDb(name="Пулково", city="Санкт-Петербург", country="Россия"),
+            AirportDb(name="Шереметьево", city="Москва", country="Россия"),
+        ]
+    )
+    db_session.commit()
+    flights = io.StringIO(
+        "flight_number,datetime,from_airport,to_airport,price\n"
+        "AFL001,2021-10-08 20:00,Пулково,Шереметьево,1500\n"
+    )
+    with pytest.raises(BulkImportError, match="line 2: several airports"):
+        import_flights(db_session, flights, "csv")
+
+
+class FakeCopyCursor:
+    """Reads a COPY FROM STDIN source the way psycopg2's copy_expert does,
+    including replacing errors raised by read() with QueryCanceled"""
+
+    def __init__(self):
+        self.data = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, sql, file, size=8192):
+        try:
+            while chunk := file.read(size):
+                self.data += chunk
+        except Exception as e:
+            raise QueryCanceled(f"error in .read() call: {e}")
+
+
+def postgres_session(cursor):
+    connection = SimpleNamespace(
+        dialect=SimpleNamespace(name="postgresql"),
+        connection=SimpleNamespace(cursor=lambda: cursor),
+    )
+    return SimpleNamespace(connection=lambda: connection)
+
+
+def schedule_csv(*prices):
+    return io.StringIO(
+        "flight_number,datetime,from_airport,to_airport,price\n"
+        + "".join(
+            f"AFL{i:03},2021-10-08 20:00,Пулково,Шереметьево,{price}\n"
+            for i, price in enumerate(prices)
+        )
+    )
+
+
+def test_bulk_import_copy(monkeypatch):
+    monkeypatch.setattr(importer, "IMPORT_COPY_CHUNK", 64)
+    cursor = FakeCopyCursor()
+    rows = flight_rows(
+        read_records(schedule_csv(*range(1500, 1510)), "csv"),
+        {"Пулково": 1, "Шереметьево": 2},
+    )
+    count = copy_rows(
+        postgres_session(cursor), FlightDb.__table__, importer.FLIGHT_COLUMNS, rows
+    )
+    assert count == 10
+    lines = cursor.data.splitlines()
+    assert len(lines) == 10
+    assert lines[3] == "AFL003,2021-10-08T20:00:00,1,2,1503"
+
+
+def test_bulk_import_copy_bad_row():
+    rows = flight_rows(
+        read_records(schedule_csv(1500, "free"), "csv"),
+        {"Пулково": 1, "Шереметьево": 2},
+    )
+    with pytest.raises(BulkImportError, match="line 3"):
+        copy_rows(
+            postgres_session(FakeCopyCursor()),
+            FlightDb.__table__,
+            importer.FLIGHT_COLUMNS,
+            rows,
+        )
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
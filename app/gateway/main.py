@@ -1,6 +1,10 @@
-from fastapi import Depends, FastAPI, HTTPException, Header, Request
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from contextlib import asynccontextmanager, suppress
+from typing import Literal
+import asyncio
 import os
 import datetime
 import uuid
@@ -28,6 +32,18 @@ IDP_ENDPOINT = os.getenv("IDP_ENDPOINT")
 AUTH_CLIENT_ID = os.getenv("AUTH_CLIENT_ID")
 AUTH_CLIENT_SECRET = os.getenv("AUTH_CLIENT_SECRET")
 JWKS_ENDPOINT = os.getenv("JWKS_ENDPOINT")
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "2"))
+# stream GET /flights from flights service as is, without parsing it
+FLIGHTS_PASSTHROUGH = os.getenv("FLIGHTS_PASSTHROUGH", "false").lower() == "true"
+# upstream headers that describe the forwarded body
+PASSTHROUGH_HEADERS = ("content-type", "content-length", "content-encoding")
+# comma separated flight numbers to put into the flights cache on startup
+WARMUP_FLIGHTS = [x for x in os.getenv("WARMUP_FLIGHTS", "").split(",") if x]
+TICKETS_MAX_PAGE_SIZE = int(os.getenv("TICKETS_MAX_PAGE_SIZE", "1000"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "1000"))
+# token scope required by the /manage/cache endpoints
+ADMIN_SCOPE = os.getenv("ADMIN_SCOPE", "gateway-admin")
 
 if FLIGHTS_SERVICE_URL is None:
     raise RuntimeError("missing FLIGHTS_SERVICE_URL")
@@ -43,22 +59,70 @@ auth_service = AuthService(IDP_ENDPOINT, AUTH_CLIENT_ID, AUTH_CLIENT_SECRET)
 jwks_service = JWKSService(JWKS_ENDPOINT)
 jwt_service = JWTService(jwks_service)
 
-jwks_service.get_jwks()
-
-app = FastAPI(title="App API", root_path="/api/v1")
+# names of warm-up steps that haven't succeeded yet
+warmup_pending = set()
+
+
+async def warm_up_step(name, step):
+    """Retry a warm-up step until it succeeds"""
+    while True:
+        try:
+            await step()
+            break
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {e}")
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+    warmup_pending.discard(name)
+    logger.info(f"Warm-up step {name} done")
+
+
+def open_connections(service):
+    # concurrent requests make the pool open several keep-alive connections
+    return lambda: fan_out(*(service.healthcheck() for _ in range(WARMUP_CONNECTIONS)))
+
+
+def warm_up() -> asyncio.Future:
+    steps = {
+        "jwks": lambda: asyncio.to_thread(jwks_service.refresh),
+        "flights": open_connections(flights_service),
+        "tickets": open_connections(tickets_service),
+        "privileges": open_connections(privileges_service),
+    }
+    if WARMUP_FLIGHTS:
+        steps["hot_flights"] = lambda: flights_service.get_flights_by_numbers(
+            WARMUP_FLIGHTS
+        )
+    warmup_pending.update(steps)
+    return asyncio.gather(*(warm_up_step(name, step) for name, step in steps.items()))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm-up runs in background so that the app starts serving (and passes
+    # startupProbe) right away, /manage/ready reports when it's finished
+    warmup = warm_up()
+    jwks_service.start()
+    yield
+    warmup.cancel()
+    with suppress(asyncio.CancelledError):
+        await warmup
+    jwks_service.stop()
+    await flights_service.aclose()
+    await tickets_service.aclose()
+    await privileges_service.aclose()
+
+
+app = FastAPI(title="App API", root_path="/api/v1", lifespan=lifespan)
 print("HELLO")
 logger.info("HELLOWOEOAWEOA")
 
 
-def get_current_user(req: Request) -> UserInfo:
-    print("checking authorization")
+def get_current_claims(req: Request) -> JWTClaims:
     authorization = req.headers.get("Authorization")
     if not authorization:
         logger.error("Missing Authorization header")
         raise HTTPException(status_code=401, detail="Authorization header missing")
 
-    print(f"got authorization {authorization}")
-
     # Extract token from "Bearer <token>"
     try:
         scheme, token = authorization.split()
@@ -71,20 +135,25 @@ def get_current_user(req: Request) -> UserInfo:
             detail="Invalid Authorization header format. Expected: Bearer <token>",
         )
 
-    print(f"got bearer {token}")
-
-    # Validate token
-    if not jwt_service.validate_token(token):
+    # Validate token and extract user info
+    claims = jwt_service.verify(token)
+    if not claims:
         logger.error("JWT token validation failed")
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
-    # Extract user info
-    user_info = jwt_service.extract_user_info(token)
-    if not user_info:
-        logger.error("Failed to extract user info from token")
-        raise HTTPException(status_code=401, detail="Invalid token claims")
+    return claims
+
+
+def get_current_user(claims: JWTClaims = Depends(get_current_claims)) -> UserInfo:
+    return UserInfo(sub=claims.sub, name=claims.preferred_username)
 
-    return user_info
+
+def get_admin_user(claims: JWTClaims = Depends(get_current_claims)) -> UserInfo:
+    """Only tokens granted ADMIN_SCOPE may use administrative endpoints"""
+    if ADMIN_SCOPE not in (claims.scope or "").split():
+        logger.warning(f"User {claims.sub} is not allowed to administer the gateway")
+        raise HTTPException(status_code=403, detail="Admin scope required")
+    return UserInfo(sub=claims.sub, name=claims.preferred_username)
 
 
 class TicketBuyBody(BaseModel):
@@ -99,18 +168,68 @@ def error_response(msg, code):
     )
 
 
+@app.exception_handler(ServiceUnavailableError)
+async def service_unavailable_handler(request: Request, exc: ServiceUnavailableError):
+    logger.error(str(exc))
+    return error_response(f"Сервис {exc.service} недоступен", 503)
+
+
 @app.get("/flights", response_model=PaginationResponse)
-def get_flights(
+async def get_flights(
     page: int = None,
     size: int = None,
+    cursor: str = None,
     current_user: UserInfo = Depends(get_current_user),
 ):
     logger.debug(f"User {current_user.sub} accessed /flights")
-    return flights_service.get_all(page, size)
+    if FLIGHTS_PASSTHROUGH:
+        upstream = await flights_service.get_all_raw(page, size, cursor)
+        return StreamingResponse(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers={
+                k: v for k, v in upstream.headers.items() if k in PASSTHROUGH_HEADERS
+            },
+            background=BackgroundTask(upstream.aclose),
+        )
+    return model_response(await flights_service.get_all(page, size, cursor))
+
+
+@app.get("/flights/search", response_model=PaginationResponse)
+async def search_flights(
+    from_airport: str = None,
+    from_city: str = None,
+    to_airport: str = None,
+    to_city: str = None,
+    date_from: datetime = None,
+    date_to: datetime = None,
+    price_min: int = None,
+    price_max: int = None,
+    sort_by: Literal["date", "price"] = None,
+    order: Literal["asc", "desc"] = None,
+    page: int = None,
+    size: int = None,
+    current_user: UserInfo = Depends(get_current_user),
+):
+    logger.debug(f"User {current_user.sub} accessed /flights/search")
+    result = await flights_service.search(
+        from_airport=from_airport,
+        from_city=from_city,
+        to_airport=to_airport,
+        to_city=to_city,
+        date_from=date_from and date_from.isoformat(),
+        date_to=date_to and date_to.isoformat(),
+        price_min=price_min,
+        price_max=price_max,
+        sort_by=sort_by,
+        order=order,
+        page=page,
+        page_size=size,
+    )
+    return model_response(result)
 
 
-def map_ticket_to_ticket_response(tick):
-    flight = flights_service.get_flight_by_number(tick.flight_number)
+def map_ticket_to_ticket_response(tick, flight):
     return TicketResponse(
         ticketUid=tick.ticket_uid,
         flightNumber=tick.flight_number,
@@ -122,54 +241,78 @@ def map_ticket_to_ticket_response(tick):
     )
 
 
+async def map_tickets_to_ticket_responses(tickets_info):
+    flights = await flights_service.get_flights_by_numbers(
+        tick.flight_number for tick in tickets_info
+    )
+    tickets = []
+    for tick in tickets_info:
+        flight = flights.get(tick.flight_number)
+        if flight is None:
+            logger.error(
+                f"Flight {tick.flight_number} for ticket {tick.ticket_uid} not found"
+            )
+            continue
+        tickets.append(map_ticket_to_ticket_response(tick, flight))
+    return tickets
+
+
 @app.get("/tickets")
-def get_tickets(
+async def get_tickets(
+    response: Response,
+    status: Optional[TicketStatus] = None,
+    limit: Optional[int] = Query(None, ge=1, le=TICKETS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: UserInfo = Depends(get_current_user),
 ) -> List[TicketResponse]:
     logger.debug(f"User {current_user.sub} accessed /tickets")
 
-    privilege = privileges_service.get_user_privelge(current_user.name)
+    privilege, page = await fan_out(
+        privileges_service.get_user_privelge(current_user.name),
+        tickets_service.get_user_tickets(current_user.name, status, limit, cursor),
+    )
     if privilege is None:
         return error_response("Пользователь не найден", 404)
-    tickets_info = tickets_service.get_user_tickets(current_user.name)
-    tickets = []
-    for tick in tickets_info:
-        tickets.append(map_ticket_to_ticket_response(tick))
-    return tickets
+    tickets = await map_tickets_to_ticket_responses(page.items)
+    headers = {NEXT_CURSOR_HEADER: str(page.next)} if page.next else {}
+    response.headers.update(headers)
+    return model_response(tickets, TicketResponseList, headers)
 
 
 @app.get("/me")
-def get_user(
+async def get_user(
     current_user: UserInfo = Depends(get_current_user),
 ) -> UserInfoResponse | ErrorResponse:
     logger.debug(f"User {current_user.sub} accessed /me")
 
-    privilege = privileges_service.get_user_privelge(current_user.name)
+    privilege, page = await fan_out(
+        privileges_service.get_user_privelge(current_user.name),
+        tickets_service.get_user_tickets(current_user.name),
+    )
     if privilege is None:
         return error_response("Пользователь не найден", 404)
-    tickets_info = tickets_service.get_user_tickets(current_user.name)
-    tickets = []
-    for tick in tickets_info:
-        tickets.append(map_ticket_to_ticket_response(tick))
-    return UserInfoResponse(
-        tickets=tickets,
-        privilege=PrivilegeShortInfo(
-            balance=privilege.balance, status=privilege.status
-        ),
+    tickets = await map_tickets_to_ticket_responses(page.items)
+    return model_response(
+        UserInfoResponse(
+            tickets=tickets,
+            privilege=PrivilegeShortInfo(
+                balance=privilege.balance, status=privilege.status
+            ),
+        )
     )
 
 
 @app.get("/tickets/{ticket_uid}")
-def get_ticket(
+async def get_ticket(
     ticket_uid: uuid.UUID,
     current_user: UserInfo = Depends(get_current_user),
 ) -> TicketResponse | ErrorResponse:
-    ticket = tickets_service.get_ticket(ticket_uid)
+    ticket = await tickets_service.get_ticket(ticket_uid)
     if ticket is None:
         return error_response("Билет не найден", 404)
     if ticket.username != current_user.name:
         return error_response("Билет не пренадлежит пользователю", 403)
-    flight = flights_service.get_flight_by_number(ticket.flight_number)
+    flight = await flights_service.get_flight_by_number(ticket.flight_number)
     if flight is None:
         return error_response("Перелет не найден", 404)
 
@@ -186,16 +329,17 @@ def get_ticket(
 
 
 @app.post("/tickets")
-def buy_ticket(
+async def buy_ticket(
     body: TicketPurchaseRequest,
     current_user: UserInfo = Depends(get_current_user),
 ) -> TicketPurchaseResponse | ValidationErrorResponse:
 
-    flight = flights_service.get_flight_by_number(body.flightNumber)
+    flight, priv = await fan_out(
+        flights_service.get_flight_by_number(body.flightNumber),
+        privileges_service.get_user_privelge(current_user.name),
+    )
     if flight is None:
         return ValidationErrorResponse(message="Ошибка валидации данных", errors=[])
-
-    priv = privileges_service.get_user_privelge(current_user.name)
     if priv is None:
         return ValidationErrorResponse(message="Пользователь не существует", errors=[])
 
@@ -209,7 +353,7 @@ def buy_ticket(
         paid_by_bonus = money
         paid_by_money = flight.price - paid_by_bonus
         if paid_by_bonus:
-            privileges_service.add_transaction(
+            priv = await privileges_service.add_transaction(
                 current_user.name,
                 AddTranscationRequest(
                     privilege_id=priv.id,
@@ -220,7 +364,7 @@ def buy_ticket(
                 ),
             )
     else:
-        privileges_service.add_transaction(
+        priv = await privileges_service.add_transaction(
             current_user.name,
             AddTranscationRequest(
                 privilege_id=priv.id,
@@ -231,8 +375,7 @@ def buy_ticket(
             ),
         )
 
-    priv = privileges_service.get_user_privelge(current_user.name)
-    tickets_service.create_ticket(
+    ticket = await tickets_service.create_ticket(
         ticket_uid, current_user.name, flight.flightNumber, paid_by_money
     )
     return TicketPurchaseResponse(
@@ -244,39 +387,49 @@ def buy_ticket(
         price=flight.price,
         paidByMoney=paid_by_money,
         paidByBonuses=paid_by_bonus,
-        status="PAID",
+        status=ticket.status,
         privilege=PrivilegeShortInfo(balance=priv.balance, status=priv.status),
     )
 
 
 @app.delete("/tickets/{ticket_uid}", status_code=204)
-def return_ticket(
+async def return_ticket(
     ticket_uid: uuid.UUID,
     current_user: UserInfo = Depends(get_current_user),
 ):
-    ticket = tickets_service.get_ticket(ticket_uid)
+    ticket, transaction = await fan_out(
+        tickets_service.get_ticket(ticket_uid),
+        privileges_service.get_user_privelge_transaction(current_user.name, ticket_uid),
+    )
     if ticket is None:
         return error_response("Билет не существует", 404)
     if ticket.username != current_user.name:
         return error_response("Билет не принадлежит пользователю", 403)
     if ticket.status != "PAID":
         return error_response("Билет не может быть отменен", 400)
-    if privileges_service.get_user_privelge_transaction(current_user.name, ticket_uid):
-        privileges_service.rollback_transaction(current_user.name, ticket_uid)
-    tickets_service.delete_ticket(ticket_uid)
+    # the writes depend on each other: the ticket is only deleted once the
+    # bonus rollback has succeeded
+    if transaction:
+        await privileges_service.rollback_transaction(current_user.name, ticket_uid)
+    await tickets_service.delete_ticket(ticket_uid)
 
 
 @app.get("/privilege")
-def get_privilege(
+async def get_privilege(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: UserInfo = Depends(get_current_user),
 ) -> PrivilegeInfoResponse:
     print("current user", current_user)
-    a = privileges_service.get_user_privelge(current_user.name)
-    if a is None:
+    summary = await privileges_service.get_user_privelge_with_history(
+        current_user.name, limit, cursor
+    )
+    if summary is None:
         return error_response("Пользователь не сущесвует", 404)
-    b = privileges_service.get_user_privelge_history(current_user.name)
+    a = summary.privilege
     his = []
-    for it in b:
+    for it in summary.history:
         his.append(
             BalanceHistory(
                 date=it.datetime,
@@ -285,7 +438,12 @@ def get_privilege(
                 operationType=it.operation_type,
             )
         )
-    return PrivilegeInfoResponse(balance=a.balance, status=a.status, history=his)
+    headers = {NEXT_CURSOR_HEADER: summary.next} if summary.next else {}
+    response.headers.update(headers)
+    return model_response(
+        PrivilegeInfoResponse(balance=a.balance, status=a.status, history=his),
+        headers=headers,
+    )
 
 
 @app.get("/manage/health", status_code=201)
@@ -293,6 +451,43 @@ def health():
     pass
 
 
+@app.get("/manage/ready")
+def ready():
+    if warmup_pending:
+        return JSONResponse(
+            content={"ready": False, "pending": sorted(warmup_pending)},
+            status_code=503,
+        )
+    return {"ready": True, "pending": []}
+
+
+@app.get("/manage/metrics")
+def metrics():
+    return {
+        "services": {
+            service.name: service.stats()
+            for service in (flights_service, tickets_service, privileges_service)
+        },
+    }
+
+
+@app.get("/manage/cache/flights")
+async def get_flights_cache_stats(
+    current_user: UserInfo = Depends(get_admin_user),
+):
+    return flights_service.cache.stats()
+
+
+@app.delete("/manage/cache/flights", status_code=204)
+async def purge_flights_cache(
+    flight_number: str = None,
+    current_user: UserInfo = Depends(get_admin_user),
+):
+    """Drop one flight (or every flight if none given) from the gateway cache"""
+    logger.info(f"User {current_user.sub} purged flights cache: {flight_number}")
+    flights_service.cache.invalidate(flight_number)
+
+
 @app.post("/authorize", response_model=TokenResponse)
 def authorize(request: TokenRequest):
     """
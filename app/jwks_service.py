@@ -1,53 +1,177 @@
 import json
+import os
+import threading
 import time
 from typing import Dict, List, Optional
 import requests
-from cachetools import TTLCache
+from jose import jwk
+from jose.backends.base import Key
 import logging
 
 logger = logging.getLogger(f"uvicorn.{__name__}")
 
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", "600"))
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "30"))
+
 
 class JWKSService:
-    def __init__(self, jwks_uri):
-        self.jwks_cache = TTLCache(maxsize=1, ttl=10000)
+    def __init__(
+        self,
+        jwks_uri,
+        refresh_interval: float = JWKS_REFRESH_INTERVAL,
+        min_refetch_interval: float = JWKS_MIN_REFETCH_INTERVAL,
+        algorithm: str = "RS256",
+    ):
         self.jwks_uri = jwks_uri
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.algorithm = algorithm
+
+        self.jwks: Optional[Dict] = None
+        # kid -> constructed public key, rebuilt on every fetch
+        self.keys: Dict[str, Key] = {}
+        self.fetched_at = 0.0
+        self.last_attempt_at = 0.0
+
+        self.fetch_lock = threading.Lock()
+        self.background_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.refresher: Optional[threading.Thread] = None
 
     def get_jwks(self) -> Dict:
-        """Get JWKS from cache or fetch from IdP"""
-        try:
-            # Try to get from cache
-            jwks = self.jwks_cache.get("jwks")
-            if jwks:
-                return jwks
+        """Get JWKS, fetching from IdP only if nothing was fetched yet. Stale
+        keys are still served while a refresh runs in the background"""
+        if self.jwks is None:
+            started = time.monotonic()
+            with self.fetch_lock:
+                if self.jwks is None:
+                    # threads that queued up behind a failed attempt fail
+                    # with it instead of hitting the IdP again one by one
+                    if self.last_attempt_at >= started:
+                        raise Exception("Unable to fetch JWKS from IdP")
+                    self._fetch()
+            return self.jwks
+        if self._refresh_due():
+            self._refresh_in_background()
+        return self.jwks
+
+    def _refresh_due(self) -> bool:
+        """Whether a request should refresh stale keys itself. That's the
+        periodic refresher's job while it keeps up, and attempts are spaced
+        by min_refetch_interval so a down IdP isn't hammered"""
+        now = time.monotonic()
+        stale_after = self.refresh_interval
+        if self.refresher is not None:
+            stale_after *= 2
+        return (
+            now - self.fetched_at > stale_after
+            and now - self.last_attempt_at >= self.min_refetch_interval
+        )
 
-            # Fetch from IdP
+    def refresh(self) -> Dict:
+        """Fetch JWKS from IdP and rebuild the key index"""
+        with self.fetch_lock:
+            return self._fetch()
+
+    def _fetch(self) -> Dict:
+        # must be called with fetch_lock held
+        try:
             logger.info(f"Fetching JWKS from {self.jwks_uri}")
             response = requests.get(
                 self.jwks_uri, timeout=10, headers={"Accept": "application/json"}
             )
             response.raise_for_status()
-
             jwks = response.json()
-            # Cache the result
-            self.jwks_cache["jwks"] = jwks
-
-            logger.info("Successfully fetched and cached JWKS")
-            return jwks
-
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to fetch JWKS: {e}")
             raise Exception("Unable to fetch JWKS from IdP")
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON response from JWKS endpoint: {e}")
             raise Exception("Invalid JWKS response")
+        finally:
+            # completion time: callers that were waiting for the lock
+            # meanwhile see this attempt as their own
+            self.last_attempt_at = time.monotonic()
 
-    def get_key_by_kid(self, kid: str) -> Optional[Dict]:
-        """Get a specific key by key ID (kid)"""
-        jwks = self.get_jwks()
-        for key in jwks.get("keys", []):
-            if key.get("kid") == kid:
+        self.keys = self._build_key_index(jwks)
+        self.jwks = jwks
+        self.fetched_at = time.monotonic()
+
+        logger.info(f"Successfully fetched JWKS with {len(self.keys)} keys")
+        return jwks
+
+    def get_key_by_kid(self, kid: str) -> Optional[Key]:
+        """Get a specific key by key ID (kid). An unknown kid usually means
+        the IdP rotated its keys, so JWKS is refetched, but no more often
+        than min_refetch_interval"""
+        self.get_jwks()
+        key = self.keys.get(kid)
+        if key is not None:
+            return key
+
+        started = time.monotonic()
+        with self.fetch_lock:
+            # another thread may have refetched while this one waited
+            key = self.keys.get(kid)
+            if key is not None or self.last_attempt_at >= started:
                 return key
-        return None
+            if started - self.last_attempt_at < self.min_refetch_interval:
+                return None
+            logger.info(f"Unknown KID {kid}, refetching JWKS")
+            try:
+                self._fetch()
+            except Exception:
+                return None
+            return self.keys.get(kid)
+
+    def start(self):
+        """Start periodic background refresh of JWKS"""
+        if self.refresher is not None:
+            return
+        self.stop_event.clear()
+        self.refresher = threading.Thread(
+            target=self._refresh_loop, name="jwks-refresher", daemon=True
+        )
+        self.refresher.start()
 
+    def stop(self):
+        self.stop_event.set()
+        if self.refresher is not None:
+            self.refresher.join(timeout=1)
+            self.refresher = None
 
+    def _refresh_loop(self):
+        while not self.stop_event.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logger.warning("Background JWKS refresh failed, keeping old keys")
+
+    def _refresh_in_background(self):
+        if not self.background_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                with self.fetch_lock:
+                    # the refresher may have fetched while this waited
+                    if self._refresh_due():
+                        self._fetch()
+            except Exception:
+                logger.warning("JWKS refresh failed, keeping old keys")
+            finally:
+                self.background_lock.release()
+
+        threading.Thread(target=refresh, name="jwks-refresh", daemon=True).start()
+
+    def _build_key_index(self, jwks: Dict) -> Dict[str, Key]:
+        keys = {}
+        for key in jwks.get("keys", []):
+            kid = key.get("kid")
+            if not kid or key.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[kid] = jwk.construct(key, key.get("alg", self.algorithm))
+            except Exception as e:
+                logger.warning(f"Skipping JWKS key {kid}: {e}")
+        return keys
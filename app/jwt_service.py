@@ -1,64 +1,107 @@
 from typing import Dict, Optional
-from jose import jwt
+from jose import jwk
+from jose.backends.base import Key
+from jose.utils import base64url_decode
 from datetime import datetime
+from cachetools import TLRUCache
+import binascii
+import hashlib
+import json
+import os
+import threading
 import time
 import logging
 from common import *
 
 logger = logging.getLogger(f"uvicorn.{__name__}")
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
 
 class JWTService:
-    def __init__(self, jwks_service):
+    def __init__(self, jwks_service, cache_size: int = TOKEN_CACHE_SIZE):
         self.algorithm = "RS256"
         self.jwks_service = jwks_service
+        # token hash -> JWTClaims, every entry expires together with its token
+        self.token_cache = TLRUCache(
+            maxsize=cache_size,
+            ttu=lambda _, claims, now: claims.exp,
+            timer=time.time,
+        )
+        self.token_cache_lock = threading.Lock()
+
+    def verify(self, token: str) -> Optional[JWTClaims]:
+        """Verify JWT token and return its claims. A token is parsed and
+        verified only once during its lifetime, later calls are served
+        from cache"""
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self.token_cache_lock:
+            claims = self.token_cache.get(cache_key)
+        if claims:
+            return claims
+
+        claims = self._decode_verified(token)
+        if claims:
+            with self.token_cache_lock:
+                self.token_cache[cache_key] = claims
+        return claims
+
+    def _decode_verified(self, token: str) -> Optional[JWTClaims]:
+        """Verify JWT token using cached JWKS, decoding each segment once"""
+        try:
+            # 1. Split and decode the token
+            signing_input, signature_segment = token.encode().rsplit(b".", 1)
+            header_segment, payload_segment = signing_input.split(b".", 1)
+            header = json.loads(base64url_decode(header_segment))
+            payload = json.loads(base64url_decode(payload_segment))
+            signature = base64url_decode(signature_segment)
+            if not isinstance(header, dict) or not isinstance(payload, dict):
+                raise ValueError("header and payload must be json objects")
+        except (ValueError, TypeError, binascii.Error) as e:
+            logger.error(f"Malformed JWT token: {e}")
+            return None
 
-    def validate_token(self, token: str) -> bool:
-        """Validate JWT token using cached JWKS"""
         try:
-            # 1. Decode header without validation to get KID
-            header = jwt.get_unverified_header(token)
-            kid = header.get("kid")
+            if header.get("alg") != self.algorithm:
+                logger.error(f"Unexpected JWT algorithm: {header.get('alg')}")
+                return None
 
+            kid = header.get("kid")
             if not kid:
                 logger.error("JWT token missing 'kid' in header")
-                return False
+                return None
 
             # 2. Get the public key by KID
             key = self.jwks_service.get_key_by_kid(kid)
             if not key:
                 logger.error(f"No key found for KID: {kid}")
-                return False
-
-            # 3. Verify the token
-            options = {
-                "verify_signature": True,
-                "verify_aud": False,
-                "verify_iss": False,
-                "require_exp": True,
-            }
-
-            # Decode with validation
-            payload = jwt.decode(
-                token,
-                key,
-                algorithms=[self.algorithm],
-                options=options,
-            )
+                return None
+            if not isinstance(key, Key):
+                key = jwk.construct(key, self.algorithm)
+
+            # 3. Verify the signature
+            if not key.verify(signing_input, signature):
+                logger.error("JWT signature verification failed")
+                return None
 
             # 4. Additional validation for OpenID Connect
             if not self._validate_oidc_claims(payload):
-                return False
+                return None
 
             logger.debug(f"Token validated for user: {payload.get('sub')}")
-            return True
+            return JWTClaims(
+                sub=payload.get("sub"),
+                exp=payload.get("exp"),
+                iat=payload.get("iat"),
+                scope=payload.get("scope"),
+                email=payload.get("email"),
+                name=payload.get("name"),
+                preferred_username=payload.get("preferred_username"),
+            )
 
-        except jwt.JWTError as e:
-            logger.error(f"JWT validation error: {e}")
-            return False
         except Exception as e:
             logger.error(f"Unexpected error during token validation: {e}")
-            return False
+            return None
 
     def _validate_oidc_claims(self, payload: Dict) -> bool:
         """Validate OpenID Connect specific claims"""
@@ -78,37 +121,9 @@ class JWTService:
             logger.error("Token expired (exp claim)")
             return False
 
-        return True
-
-    def extract_user_info(self, token: str) -> Optional[UserInfo]:
-        """Extract user information from JWT token"""
-        try:
-            # Decode without validation (we've already validated)
-            payload = jwt.get_unverified_claims(token)
-            print("payload", payload)
-            return UserInfo(
-                sub=payload.get("sub"),
-                name=payload.get("preferred_username"),
-            )
-        except Exception as e:
-            logger.error(f"Failed to extract user info: {e}")
-            return None
-
-    def get_claims(self, token: str) -> Optional[JWTClaims]:
-        """Get JWT claims"""
-        try:
-            payload = jwt.get_unverified_claims(token)
+        nbf = payload.get("nbf")
+        if nbf and nbf > time.time():
+            logger.error("Token not yet valid (nbf claim)")
+            return False
 
-            return JWTClaims(
-                sub=payload.get("sub"),
-                exp=payload.get("exp"),
-                iat=payload.get("iat"),
-                iss=payload.get("iss"),
-                aud=payload.get("aud"),
-                scope=payload.get("scope"),
-                email=payload.get("email"),
-                name=payload.get("name"),
-            )
-        except Exception as e:
-            logger.error(f"Failed to get claims: {e}")
-            return None
+        return True
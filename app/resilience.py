@@ -0,0 +1,137 @@
+import time
+import logging
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(f"uvicorn.{__name__}")
+
+# absolute unix time (seconds) after which the caller no longer needs the
+# response
+DEADLINE_HEADER = "X-Request-Deadline"
+
+
+class ServiceUnavailableError(Exception):
+    def __init__(self, service: str, reason: str):
+        super().__init__(f"{service} service unavailable: {reason}")
+        self.service = service
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """Fails calls fast after `failure_threshold` consecutive failures. After
+    `reset_timeout` seconds a single trial call is let through: its success
+    closes the breaker, its failure opens it again. A trial that ends
+    without a verdict (cancelled) is released with release_trial(), one
+    that hangs is replaced by a new trial after another `reset_timeout`."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started_at = 0.0
+        self.rejected = 0
+
+    def before_call(self) -> bool:
+        """Raises ServiceUnavailableError if the call must not be made,
+        returns whether it is the half-open trial"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise ServiceUnavailableError(self.name, "circuit breaker is open")
+            self.state = self.HALF_OPEN
+            self.trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if (
+                self.trial_in_flight
+                and now - self.trial_started_at < self.reset_timeout
+            ):
+                self.rejected += 1
+                raise ServiceUnavailableError(self.name, "circuit breaker is open")
+            self.trial_in_flight = True
+            self.trial_started_at = now
+            return True
+        return False
+
+    def release_trial(self):
+        """The trial call ended without a verdict, let the next call try"""
+        if self.state == self.HALF_OPEN:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit breaker for {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker for {self.name} opened")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutiveFailures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class RetryBudget:
+    """Token bucket limiting retries to `ratio` of all requests, so retries
+    can't multiply load on a backend that is already struggling"""
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        self.retries += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "tokens": round(self.tokens, 2),
+            "retries": self.retries,
+            "exhausted": self.exhausted,
+        }
+
+
+async def abandon_late_requests(request: Request, call_next):
+    """Middleware for backend services: don't start work the caller has
+    already given up on"""
+    deadline = request.headers.get(DEADLINE_HEADER)
+    if deadline:
+        try:
+            expired = float(deadline) <= time.time()
+        except ValueError:
+            expired = False
+        if expired:
+            logger.warning(f"Dropping {request.method} {request.url.path}: late")
+            return JSONResponse(
+                content={"detail": "Request deadline exceeded"}, status_code=504
+            )
+    return await call_next(request)
@@ -1,55 +1,418 @@
 from common import *
-import requests
+from resilience import *
+import asyncio
+import os
+import time
+import httpx
+from cachetools import TTLCache
 
+SERVICE_POOL_SIZE = int(os.getenv("SERVICE_POOL_SIZE", "100"))
+SERVICE_KEEPALIVE_SIZE = int(os.getenv("SERVICE_KEEPALIVE_SIZE", "20"))
+SERVICE_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "5"))
+SERVICE_CONNECT_TIMEOUT = float(os.getenv("SERVICE_CONNECT_TIMEOUT", "2"))
+SERVICE_MAX_RETRIES = int(os.getenv("SERVICE_MAX_RETRIES", "2"))
+SERVICE_RETRY_BACKOFF = float(os.getenv("SERVICE_RETRY_BACKOFF", "0.05"))
+SERVICE_RETRY_RATIO = float(os.getenv("SERVICE_RETRY_RATIO", "0.1"))
+SERVICE_RETRY_MAX_TOKENS = float(os.getenv("SERVICE_RETRY_MAX_TOKENS", "10"))
+SERVICE_BREAKER_FAILURES = int(os.getenv("SERVICE_BREAKER_FAILURES", "5"))
+SERVICE_BREAKER_RESET = float(os.getenv("SERVICE_BREAKER_RESET", "10"))
+SERVICE_SINGLE_FLIGHT = os.getenv("SERVICE_SINGLE_FLIGHT", "true").lower() == "true"
+FLIGHTS_BATCH_LIMIT = int(os.getenv("FLIGHTS_BATCH_LIMIT", "500"))
+TICKETS_BATCH_LIMIT = int(os.getenv("TICKETS_BATCH_LIMIT", "500"))
+FLIGHT_CACHE_SIZE = int(os.getenv("FLIGHT_CACHE_SIZE", "10000"))
+FLIGHT_CACHE_TTL = float(os.getenv("FLIGHT_CACHE_TTL", "300"))
+FLIGHT_CACHE_NEGATIVE_TTL = float(os.getenv("FLIGHT_CACHE_NEGATIVE_TTL", "30"))
 
-class FlightsService:
-    def __init__(self, url):
+
+async def fan_out(*calls):
+    """Run independent upstream calls concurrently and return their results
+    in order. If one of them fails the rest are cancelled and its exception
+    is raised as is."""
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(call) for call in calls]
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+    return [task.result() for task in tasks]
+
+
+class LookupCache:
+    """In-process TTL cache bounded by LRU eviction. Lookups that came back
+    404 are remembered separately (with their own, usually shorter, TTL) so
+    repeated requests for unknown keys don't hit the backend either."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.found = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.missing = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return cached value, None for a cached 404 or MISSING"""
+        value = self.found.get(key, self.MISSING)
+        if value is self.MISSING and key in self.missing:
+            value = None
+        if value is self.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if value is None:
+            self.found.pop(key, None)
+            self.missing[key] = True
+        else:
+            self.missing.pop(key, None)
+            self.found[key] = value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.found.clear()
+            self.missing.clear()
+        else:
+            self.found.pop(key, None)
+            self.missing.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.found),
+            "negativeSize": len(self.missing),
+            "maxSize": self.found.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls: while a call for a key is in
+    flight, other callers wait for it and get the same result (or error)."""
+
+    def __init__(self):
+        self.in_flight: dict = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, call):
+        task = self.in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.create_task(call())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+        # a cancelled caller must not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key, task: asyncio.Task):
+        self.in_flight.pop(key, None)
+        if not task.cancelled():
+            # mark the error as retrieved even if every caller has gone away
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "inFlight": len(self.in_flight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
+
+
+class BaseService:
+    """One long-lived pooled keep-alive client per backend. Every call gets
+    a deadline (also sent downstream in DEADLINE_HEADER), failed idempotent
+    calls are retried within a retry budget and a circuit breaker fails
+    calls fast while the backend is down."""
+
+    name = "backend"
+    idempotent_methods = {"GET"}
+
+    def __init__(
+        self,
+        url,
+        pool_size: int = SERVICE_POOL_SIZE,
+        keepalive_size: int = SERVICE_KEEPALIVE_SIZE,
+        timeout: float = None,
+    ):
+        if timeout is None:
+            timeout = float(
+                os.getenv(f"{self.name.upper()}_SERVICE_TIMEOUT", SERVICE_TIMEOUT)
+            )
         self.url = url
+        self.timeout = timeout
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=min(keepalive_size, pool_size),
+            ),
+            timeout=httpx.Timeout(timeout, connect=SERVICE_CONNECT_TIMEOUT),
+        )
+        self.breaker = CircuitBreaker(
+            self.name, SERVICE_BREAKER_FAILURES, SERVICE_BREAKER_RESET
+        )
+        self.retry_budget = RetryBudget(SERVICE_RETRY_RATIO, SERVICE_RETRY_MAX_TOKENS)
+        self.single_flight = SingleFlight() if SERVICE_SINGLE_FLIGHT else None
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
-        response.raise_for_status()
+    async def _request(
+        self, method: str, path: str, timeout: float = None, **kwargs
+    ) -> httpx.Response:
+        if "params" in kwargs:
+            kwargs["params"] = {
+                k: v for k, v in kwargs["params"].items() if v is not None
+            }
+        if (
+            self.single_flight is None
+            or method not in self.idempotent_methods
+            or set(kwargs) - {"params"}
+        ):
+            return await self._send(method, path, timeout, **kwargs)
+
+        params = kwargs.get("params", {})
+        key = (
+            method,
+            path,
+            tuple(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in sorted(params.items())
+            ),
+        )
+        return await self.single_flight.do(
+            key, lambda: self._send(method, path, timeout, **kwargs)
+        )
+
+    async def _send(
+        self, method: str, path: str, timeout: float = None, **kwargs
+    ) -> httpx.Response:
+        deadline = time.time() + (timeout or self.timeout)
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}),
+            DEADLINE_HEADER: f"{deadline:.3f}",
+        }
+
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            trial = self.breaker.before_call()
+            remaining = deadline - time.time()
+            error = None
+            try:
+                response = await self.client.request(
+                    method,
+                    path,
+                    timeout=httpx.Timeout(
+                        remaining, connect=min(remaining, SERVICE_CONNECT_TIMEOUT)
+                    ),
+                    **kwargs,
+                )
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                response, error = None, e
+            except BaseException:
+                # cancelled (e.g. by fan_out): no verdict on the backend
+                if trial:
+                    self.breaker.release_trial()
+                raise
+            else:
+                if response.status_code < 500:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+
+            attempt += 1
+            backoff = SERVICE_RETRY_BACKOFF * attempt
+            if (
+                method not in self.idempotent_methods
+                or attempt > SERVICE_MAX_RETRIES
+                or deadline - time.time() <= backoff
+                or not self.retry_budget.withdraw()
+            ):
+                if error is not None:
+                    raise ServiceUnavailableError(self.name, repr(error)) from error
+                return response
+            await asyncio.sleep(backoff)
 
-    def get_all(self, page: int = None, size: int = None):
-        response = requests.get(
-            f"{self.url}/flights", params={"page": page, "size": size}
+    async def _stream(
+        self, method: str, path: str, params: dict = None, timeout: float = None
+    ) -> httpx.Response:
+        """Send request without reading the body. The caller must aclose()
+        the response. Streamed requests are neither retried nor coalesced"""
+        timeout = timeout or self.timeout
+        request = self.client.build_request(
+            method,
+            path,
+            params={k: v for k, v in (params or {}).items() if v is not None},
+            headers={DEADLINE_HEADER: f"{time.time() + timeout:.3f}"},
+            timeout=httpx.Timeout(
+                timeout, connect=min(timeout, SERVICE_CONNECT_TIMEOUT)
+            ),
         )
+        trial = self.breaker.before_call()
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.TransportError as e:
+            self.breaker.record_failure()
+            raise ServiceUnavailableError(self.name, repr(e)) from e
+        except BaseException:
+            if trial:
+                self.breaker.release_trial()
+            raise
+        if response.status_code < 500:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "timeout": self.timeout,
+            "breaker": self.breaker.stats(),
+            "retryBudget": self.retry_budget.stats(),
+            "singleFlight": self.single_flight and self.single_flight.stats(),
+        }
+
+    async def healthcheck(self):
+        # not coalesced: concurrent healthchecks are how warm-up opens
+        # several pooled connections
+        response = await self._send("GET", "/manage/health")
         response.raise_for_status()
-        return PaginationResponse.model_validate(response.json())
 
-    def get_flight_by_number(self, flight_number: str) -> FlightResponse:
-        response = requests.get(f"{self.url}/flights/{flight_number}")
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class FlightsService(BaseService):
+    name = "flights"
+
+    def __init__(
+        self,
+        url,
+        cache_size: int = FLIGHT_CACHE_SIZE,
+        cache_ttl: float = FLIGHT_CACHE_TTL,
+        cache_negative_ttl: float = FLIGHT_CACHE_NEGATIVE_TTL,
+        **kwargs,
+    ):
+        super().__init__(url, **kwargs)
+        self.cache = LookupCache(cache_size, cache_ttl, cache_negative_ttl)
+
+    async def get_all(self, page: int = None, size: int = None, cursor: str = None):
+        response = await self._request(
+            "GET",
+            "/flights",
+            params={"page": page, "page_size": size, "cursor": cursor},
+        )
         response.raise_for_status()
-        return FlightResponse.model_validate(response.json())
+        return PaginationResponse.model_validate_json(response.content)
 
+    async def get_all_raw(self, page: int = None, size: int = None, cursor: str = None):
+        """Same as get_all, but the response body is left unread"""
+        return await self._stream(
+            "GET",
+            "/flights",
+            params={"page": page, "page_size": size, "cursor": cursor},
+        )
 
-class TicketsService:
-    def __init__(self, url):
-        self.url = url
+    async def search(self, **filters) -> PaginationResponse:
+        response = await self._request("GET", "/flights/search", params=filters)
+        response.raise_for_status()
+        return PaginationResponse.model_validate_json(response.content)
+
+    async def get_flight_by_number(self, flight_number: str) -> FlightResponse | None:
+        flight = self.cache.get(flight_number)
+        if flight is not LookupCache.MISSING:
+            return flight
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
+        response = await self._request("GET", f"/flights/{flight_number}")
+        if response.status_code == 404:
+            self.cache.put(flight_number, None)
+            return None
         response.raise_for_status()
+        flight = FlightResponse.model_validate_json(response.content)
+        self.cache.put(flight_number, flight)
+        return flight
+
+    async def get_flights_by_numbers(self, flight_numbers) -> dict[str, FlightResponse]:
+        """Resolve distinct flight numbers with as few requests as possible"""
+        flights = {}
+        numbers = []
+        for number in sorted(set(flight_numbers)):
+            flight = self.cache.get(number)
+            if flight is LookupCache.MISSING:
+                numbers.append(number)
+            elif flight is not None:
+                flights[number] = flight
 
-    def get_user_tickets(self, username) -> list[Ticket]:
-        response = requests.get(f"{self.url}/tickets/user/{username}")
+        for i in range(0, len(numbers), FLIGHTS_BATCH_LIMIT):
+            chunk = numbers[i : i + FLIGHTS_BATCH_LIMIT]
+            response = await self._request(
+                "GET", "/flights/batch", params={"numbers": chunk}
+            )
+            response.raise_for_status()
+            for flight in FlightResponseList.validate_json(response.content):
+                flights[flight.flightNumber] = flight
+            for number in chunk:
+                self.cache.put(number, flights.get(number))
+        return flights
+
+
+class TicketsService(BaseService):
+    name = "tickets"
+
+    async def get_user_tickets(
+        self,
+        username,
+        status: TicketStatus = None,
+        limit: int = None,
+        cursor: str = None,
+    ) -> TicketPage:
+        """A page of user tickets, all of them when limit is not set"""
+        response = await self._request(
+            "GET",
+            f"/tickets/user/{username}",
+            params={
+                "status": status.value if status else None,
+                "limit": limit,
+                "cursor": cursor,
+            },
+        )
         response.raise_for_status()
-        return [Ticket.model_validate(x) for x in response.json()]
+        return TicketPage(
+            items=TicketList.validate_json(response.content),
+            next=response.headers.get(NEXT_CURSOR_HEADER),
+        )
 
-    def get_ticket(self, ticket_uid) -> Ticket | None:
-        response = requests.get(f"{self.url}/tickets/{ticket_uid}")
+    async def get_ticket(self, ticket_uid) -> Ticket | None:
+        response = await self._request("GET", f"/tickets/{ticket_uid}")
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        return Ticket.model_validate(response.json())
+        return Ticket.model_validate_json(response.content)
+
+    async def get_tickets_by_uids(self, ticket_uids) -> dict[uuid.UUID, Ticket]:
+        """Fetch tickets in batches of TICKETS_BATCH_LIMIT, unknown uids are
+        missing from the result"""
+        uids = sorted({str(uid) for uid in ticket_uids})
+        tickets = {}
+        for i in range(0, len(uids), TICKETS_BATCH_LIMIT):
+            response = await self._request(
+                "POST", "/tickets/batch", json=uids[i : i + TICKETS_BATCH_LIMIT]
+            )
+            response.raise_for_status()
+            for ticket in TicketList.validate_json(response.content):
+                tickets[ticket.ticket_uid] = ticket
+        return tickets
 
-    def delete_ticket(self, ticket_uid) -> None:
-        response = requests.delete(f"{self.url}/tickets/{ticket_uid}")
+    async def delete_ticket(self, ticket_uid) -> None:
+        response = await self._request("DELETE", f"/tickets/{ticket_uid}")
         response.raise_for_status()
 
-    def create_ticket(self, ticket_uid, username, flight_number, price):
-        response = requests.post(
-            f"{self.url}/tickets",
+    async def create_ticket(self, ticket_uid, username, flight_number, price) -> Ticket:
+        response = await self._request(
+            "POST",
+            "/tickets",
             json=TicketCreateRequest(
                 ticketUid=ticket_uid,
                 username=username,
@@ -58,45 +421,57 @@ class TicketsService:
             ).model_dump(mode="json"),
         )
         response.raise_for_status()
+        return Ticket.model_validate_json(response.content)
 
 
-class PrivilegesService:
-    def __init__(self, url):
-        self.url = url
+class PrivilegesService(BaseService):
+    name = "privileges"
 
-    def healthcheck(self):
-        response = requests.get(f"{self.url}/manage/health")
-        response.raise_for_status()
-
-    def get_user_privelge(self, username) -> Privilege:
-        response = requests.get(f"{self.url}/privilege/{username}")
+    async def get_user_privelge(self, username) -> Privilege:
+        response = await self._request("GET", f"/privilege/{username}")
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        privilege = Privilege.model_validate(response.json())
-        return privilege
+        return Privilege.model_validate_json(response.content)
 
-    def get_user_privelge_history(self, username) -> list[PrivilegeHistory]:
-        response = requests.get(f"{self.url}/privilege/{username}/history")
+    async def get_user_privelge_with_history(
+        self, username, limit: int = None, cursor: str = None
+    ) -> PrivilegeWithHistory | None:
+        """Privilege and a page of its history in one call, the whole history
+        when limit is not set"""
+        response = await self._request(
+            "GET",
+            f"/privilege/{username}/summary",
+            params={"limit": limit, "cursor": cursor},
+        )
+        if response.status_code == 404:
+            return None
         response.raise_for_status()
-        return [PrivilegeHistory.model_validate(x) for x in response.json()]
+        return PrivilegeWithHistory.model_validate_json(response.content)
 
-    def get_user_privelge_transaction(self, username, ticket_uid) -> PrivilegeHistory:
-        response = requests.get(f"{self.url}/privilege/{username}/history/{ticket_uid}")
+    async def get_user_privelge_transaction(
+        self, username, ticket_uid
+    ) -> PrivilegeHistory:
+        response = await self._request(
+            "GET", f"/privilege/{username}/history/{ticket_uid}"
+        )
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        return PrivilegeHistory.model_validate(response.json())
+        return PrivilegeHistory.model_validate_json(response.content)
 
-    def add_transaction(self, username, data: AddTranscationRequest):
-        response = requests.post(
-            f"{self.url}/privilege/{username}/history",
+    async def add_transaction(self, username, data: AddTranscationRequest) -> Privilege:
+        """Returns the privilege with the updated balance"""
+        response = await self._request(
+            "POST",
+            f"/privilege/{username}/history",
             json=data.model_dump(mode="json"),
         )
         response.raise_for_status()
+        return Privilege.model_validate_json(response.content)
 
-    def rollback_transaction(self, username, ticket_uid):
-        response = requests.delete(
-            f"{self.url}/privilege/{username}/history/{ticket_uid}"
+    async def rollback_transaction(self, username, ticket_uid):
+        response = await self._request(
+            "DELETE", f"/privilege/{username}/history/{ticket_uid}"
         )
         response.raise_for_status()
@@ -0,0 +1,12 @@
+"""Helpers shared by the services' tests"""
+
+from sqlalchemy import text
+
+
+def query_plan(db_session, query) -> str:
+    """EXPLAIN QUERY PLAN of an ORM query, joined into one string"""
+    sql = query.statement.compile(
+        db_session.get_bind(), compile_kwargs={"literal_binds": True}
+    )
+    rows = db_session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+    return " | ".join(row[-1] for row in rows)
@@ -1,9 +1,10 @@
 import uuid
-from fastapi import FastAPI, HTTPException, Depends, Path
+from fastapi import FastAPI, HTTPException, Depends, Path, Query, Response
 from sqlalchemy import create_engine, Column, Integer, String, UUID
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from sqlalchemy import Column, Integer, String, StaticPool
+from sqlalchemy import Column, Integer, String, StaticPool, Index, TIMESTAMP, func
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
 import os
 import sys
 import inspect
@@ -13,6 +14,7 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from common import *
+from resilience import abandon_late_requests
 
 if not os.getenv("TESTING"):
     DB_USER = os.getenv("POSTGRES_USER", "postgres")
@@ -37,7 +39,11 @@ else:
         poolclass=StaticPool,
     )
 
+TICKETS_MAX_PAGE_SIZE = int(os.getenv("TICKETS_MAX_PAGE_SIZE", "1000"))
+TICKETS_BATCH_LIMIT = int(os.getenv("TICKETS_BATCH_LIMIT", "500"))
+
 app = FastAPI(title="Tickets API")
+app.middleware("http")(abandon_late_requests)
 
 
 def get_db():
@@ -52,17 +58,100 @@ class TicketDb(Base):
     __tablename__ = "ticket"
 
     id = Column(Integer, primary_key=True)
-    ticket_uid = Column(UUID(as_uuid=True), nullable=False)
+    ticket_uid = Column(UUID(as_uuid=True), nullable=False, unique=True)
     username = Column(String(80), nullable=False)
     flight_number = Column(String(20), nullable=False)
     price = Column(Integer, nullable=False)
     status = Column(String(20), nullable=False)
+    created_at = Column(
+        TIMESTAMP(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    __table_args__ = (
+        Index("ticket_username_id_idx", "username", "id"),
+        # covers the stats GROUP BY, counts and sums come from the index alone
+        Index("ticket_flight_status_idx", "flight_number", "status", "price"),
+        Index("ticket_created_at_idx", "created_at"),
+    )
 
 
 @app.get("/tickets/user/{username}", response_model=List[Ticket])
-def get_tickets_by_user(username: str, db: Session = Depends(get_db)):
-    tickets = db.query(TicketDb).filter(TicketDb.username == username).all()
-    return tickets
+def get_tickets_by_user(
+    username: str,
+    response: Response,
+    status: Optional[TicketStatus] = None,
+    limit: Optional[int] = Query(None, ge=1, le=TICKETS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Tickets of a user ordered by id. With limit only one page is returned,
+    the cursor of the next one is sent in the X-Next-Cursor header"""
+    query = db.query(TicketDb).filter(TicketDb.username == username)
+    if status is not None:
+        query = query.filter(TicketDb.status == status.value)
+    if cursor:
+        (after_id,) = decode_cursor(cursor, i=int)
+        query = query.filter(TicketDb.id > after_id)
+    query = query.order_by(TicketDb.id)
+    if limit is None:
+        return rows_response(query.all(), TicketList)
+
+    tickets = query.limit(limit + 1).all()
+    headers = {}
+    if len(tickets) > limit:
+        tickets = tickets[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(i=tickets[-1].id)
+    response.headers.update(headers)
+    return rows_response(tickets, TicketList, headers)
+
+
+@app.get("/tickets/stats", response_model=List[FlightSalesResponse])
+def get_sales_stats(
+    since: Optional[datetime] = Query(None, alias="from"),
+    until: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+):
+    """Ticket count and revenue per flight and status, for tickets created
+    in [from, to) when given"""
+    query = db.query(
+        TicketDb.flight_number,
+        TicketDb.status,
+        func.count().label("tickets"),
+        func.sum(TicketDb.price).label("revenue"),
+    )
+    if since is not None:
+        query = query.filter(TicketDb.created_at >= since)
+    if until is not None:
+        query = query.filter(TicketDb.created_at < until)
+    rows = (
+        query.group_by(TicketDb.flight_number, TicketDb.status)
+        .order_by(TicketDb.flight_number, TicketDb.status)
+        .all()
+    )
+    return [
+        FlightSalesResponse(
+            flightNumber=row.flight_number,
+            status=row.status,
+            tickets=row.tickets,
+            revenue=row.revenue,
+        )
+        for row in rows
+    ]
+
+
+@app.post("/tickets/batch", response_model=List[Ticket])
+def get_tickets_by_uids(ticket_uids: List[uuid.UUID], db: Session = Depends(get_db)):
+    """Tickets with the given uids in one query, unknown uids are skipped"""
+    ticket_uids = set(ticket_uids)
+    if len(ticket_uids) > TICKETS_BATCH_LIMIT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many ticket uids, max is {TICKETS_BATCH_LIMIT}",
+        )
+    if not ticket_uids:
+        return []
+    tickets = db.query(TicketDb).filter(TicketDb.ticket_uid.in_(ticket_uids)).all()
+    return rows_response(tickets, TicketList)
 
 
 @app.get("/tickets/{ticket_uid}", response_model=Ticket)
@@ -73,25 +162,35 @@ def get_ticket_by_uid(ticket_uid: uuid.UUID, db: Session = Depends(get_db)):
     return ticket
 
 
-@app.post("/tickets", status_code=201)
+def insert_or_ignore(db: Session):
+    """INSERT ... ON CONFLICT DO NOTHING for the session's dialect"""
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(TicketDb)
+    return sqlite.insert(TicketDb)
+
+
+@app.post("/tickets", status_code=201, response_model=Ticket)
 def create_ticket(request: TicketCreateRequest, db: Session = Depends(get_db)):
-    existing = (
-        db.query(TicketDb).filter(TicketDb.ticket_uid == request.ticketUid).first()
+    # one round trip: a duplicate uid inserts nothing and returns no row
+    statement = (
+        insert_or_ignore(db)
+        .values(
+            ticket_uid=request.ticketUid,
+            username=request.username,
+            flight_number=request.flightNumber,
+            price=request.price,
+            status="PAID",
+        )
+        .on_conflict_do_nothing(index_elements=["ticket_uid"])
+        .returning(*TicketDb.__table__.columns)
     )
-    if existing:
+    created = db.execute(statement).mappings().first()
+    db.commit()
+    if created is None:
         raise HTTPException(
             status_code=403, detail="Ticket with this UUID already exists"
         )
-
-    new_ticket = TicketDb(
-        ticket_uid=request.ticketUid,
-        username=request.username,
-        flight_number=request.flightNumber,
-        price=request.price,
-        status="PAID",
-    )
-    db.add(new_ticket)
-    db.commit()
+    return dict(created)
 
 
 @app.delete("/tickets/{ticket_uid}", status_code=204)
@@ -2,12 +2,15 @@ from datetime import datetime
 from uuid import uuid4
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import func
 from sqlalchemy.orm import sessionmaker
 import os
 
 os.environ["TESTING"] = "True"
 
 from main import app, get_db, Base, TicketDb, engine
+from testing import query_plan
+import common
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -42,6 +45,11 @@ def client():
     Base.metadata.drop_all(bind=engine)
 
 
+@pytest.fixture(params=[False, True], ids=["response_model", "fast_json"])
+def fast_json(request, monkeypatch):
+    monkeypatch.setattr(common, "FAST_JSON", request.param)
+
+
 @pytest.fixture
 def test_ticket(db_session):
     ticket = TicketDb(
@@ -68,7 +76,7 @@ def test_get_user_ticket_invalid(client):
     assert response.status_code == 404
 
 
-def test_get_user_ticket(client, test_ticket):
+def test_get_user_ticket(client, test_ticket, fast_json):
     response = client.get(f"/tickets/user/{test_ticket.username}")
     assert response.status_code == 200
     data = response.json()
@@ -77,6 +85,126 @@ def test_get_user_ticket(client, test_ticket):
     assert data[0]["flight_number"] == test_ticket.flight_number
 
 
+def test_get_user_tickets_paginated(client, db_session, fast_json):
+    for i in range(5):
+        db_session.add(
+            TicketDb(
+                ticket_uid=uuid4(),
+                username="moose",
+                flight_number=f"AFL{i}",
+                price=1000,
+                status="CANCELED" if i == 2 else "PAID",
+            )
+        )
+    db_session.add(
+        TicketDb(
+            ticket_uid=uuid4(),
+            username="other",
+            flight_number="AFL9",
+            price=1000,
+            status="PAID",
+        )
+    )
+    db_session.commit()
+
+    seen = []
+    params = {"limit": 2, "status": "PAID"}
+    while True:
+        response = client.get("/tickets/user/moose", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen += [x["flight_number"] for x in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert seen == ["AFL0", "AFL1", "AFL3", "AFL4"]
+
+    response = client.get("/tickets/user/moose", params={"limit": 0})
+    assert response.status_code == 422
+    response = client.get("/tickets/user/moose", params={"cursor": "3"})
+    assert response.status_code == 400
+
+
+def test_get_tickets_batch(client, db_session, fast_json):
+    tickets = [
+        TicketDb(
+            ticket_uid=uuid4(),
+            username="moose",
+            flight_number=f"AFL{i}",
+            price=1000,
+            status="PAID",
+        )
+        for i in range(3)
+    ]
+    db_session.add_all(tickets)
+    db_session.commit()
+
+    uids = [str(t.ticket_uid) for t in tickets[:2]] + [str(uuid4())]
+    response = client.post("/tickets/batch", json=uids)
+    assert response.status_code == 200
+    assert sorted(x["flight_number"] for x in response.json()) == ["AFL0", "AFL1"]
+
+    response = client.post("/tickets/batch", json=[str(uuid4()) for _ in range(501)])
+    assert response.status_code == 400
+
+
+def test_sales_stats(client, db_session):
+    rows = [
+        ("AFL1", "PAID", 1000, datetime(2024, 1, 1)),
+        ("AFL1", "PAID", 1500, datetime(2024, 1, 2)),
+        ("AFL1", "CANCELED", 1000, datetime(2024, 1, 2)),
+        ("AFL2", "PAID", 700, datetime(2024, 2, 1)),
+    ]
+    for flight_number, status, price, created_at in rows:
+        db_session.add(
+            TicketDb(
+                ticket_uid=uuid4(),
+                username="moose",
+                flight_number=flight_number,
+                price=price,
+                status=status,
+                created_at=created_at,
+            )
+        )
+    db_session.commit()
+
+    response = client.get("/tickets/stats")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"flightNumber": "AFL1", "status": "CANCELED", "tickets": 1, "revenue": 1000},
+        {"flightNumber": "AFL1", "status": "PAID", "tickets": 2, "revenue": 2500},
+        {"flightNumber": "AFL2", "status": "PAID", "tickets": 1, "revenue": 700},
+    ]
+
+    response = client.get(
+        "/tickets/stats", params={"from": "2024-01-02T00:00:00", "to": "2024-02-01"}
+    )
+    assert [(x["flightNumber"], x["tickets"]) for x in response.json()] == [
+        ("AFL1", 1),
+        ("AFL1", 1),
+    ]
+
+
+def test_sales_stats_use_index(db_session):
+    query = db_session.query(
+        TicketDb.flight_number, TicketDb.status, func.count(), func.sum(TicketDb.price)
+    ).group_by(TicketDb.flight_number, TicketDb.status)
+    plan = query_plan(db_session, query)
+    assert "USING COVERING INDEX ticket_flight_status_idx" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_user_tickets_use_index(db_session):
+    query = (
+        db_session.query(TicketDb)
+        .filter(TicketDb.username == "moose", TicketDb.id > 10)
+        .order_by(TicketDb.id)
+    )
+    plan = query_plan(db_session, query)
+    assert "USING INDEX ticket_username_id_idx" in plan
+    assert "TEMP B-TREE" not in plan
+
+
 def test_get_ticket(client, test_ticket):
     response = client.get(f"/tickets/{test_ticket.ticket_uid}")
     assert response.status_code == 200
@@ -97,8 +225,24 @@ def test_post_ticket(client):
         },
     )
     assert response.status_code == 201
+    assert response.json()["ticket_uid"] == str(uid)
+    assert response.json()["status"] == "PAID"
     response = client.get(f"/tickets/{uid}")
     assert response.status_code == 200
     data = response.json()
     assert data["username"] == "moose"
     assert data["flight_number"] == "AAAA"
+
+
+def test_post_ticket_duplicate(client, test_ticket, db_session):
+    response = client.post(
+        "/tickets",
+        json={
+            "ticketUid": str(test_ticket.ticket_uid),
+            "username": "other",
+            "flightNumber": "BBBB",
+            "price": 10,
+        },
+    )
+    assert response.status_code == 403
+    assert db_session.query(TicketDb).count() == 1
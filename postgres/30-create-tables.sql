@@ -10,9 +10,14 @@ CREATE TABLE ticket
     flight_number VARCHAR(20) NOT NULL,
     price         INT         NOT NULL,
     status        VARCHAR(20) NOT NULL
-        CHECK (status IN ('PAID', 'CANCELED'))
+        CHECK (status IN ('PAID', 'CANCELED')),
+    created_at    TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
 );
 
+CREATE INDEX ticket_username_id_idx ON ticket (username, id);
+CREATE INDEX ticket_flight_status_idx ON ticket (flight_number, status, price);
+CREATE INDEX ticket_created_at_idx ON ticket (created_at);
+
 \c flights
 set role program;
 
@@ -34,6 +39,11 @@ CREATE TABLE flight
     price           INT                      NOT NULL
 );
 
+CREATE UNIQUE INDEX flight_flight_number_idx ON flight (flight_number);
+CREATE INDEX flight_datetime_id_idx ON flight (datetime, id);
+CREATE INDEX flight_route_datetime_idx ON flight (from_airport_id, to_airport_id, datetime);
+CREATE INDEX flight_route_price_idx ON flight (from_airport_id, to_airport_id, price);
+
 \c privileges
 set role program;
 
@@ -57,3 +67,6 @@ CREATE TABLE privilege_history
         CHECK (operation_type IN ('FILL_IN_BALANCE', 'DEBIT_THE_ACCOUNT'))
 );
 
+CREATE INDEX privilege_history_ticket_idx ON privilege_history (privilege_id, ticket_uid);
+CREATE INDEX privilege_history_datetime_id_idx ON privilege_history (privilege_id, datetime, id);
+
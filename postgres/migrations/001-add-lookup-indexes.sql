@@ -0,0 +1,28 @@
+-- Adds indexes from 30-create-tables.sql to databases created before them.
+-- Safe to run repeatedly. Indexes are built CONCURRENTLY so tables stay
+-- writable, so run it outside of a transaction:
+--   psql -U program -h <host> -f postgres/migrations/001-add-lookup-indexes.sql
+-- flight_flight_number_idx fails if flight numbers are duplicated, find them
+-- with: SELECT flight_number FROM flight GROUP BY 1 HAVING count(*) > 1;
+
+\c tickets
+set role program;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_username_idx ON ticket (username);
+ANALYZE ticket;
+
+\c flights
+set role program;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS flight_flight_number_idx ON flight (flight_number);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flight_datetime_id_idx ON flight (datetime, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flight_route_datetime_idx ON flight (from_airport_id, to_airport_id, datetime);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS flight_route_price_idx ON flight (from_airport_id, to_airport_id, price);
+ANALYZE flight;
+
+\c privileges
+set role program;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS privilege_history_ticket_idx ON privilege_history (privilege_id, ticket_uid);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS privilege_history_datetime_idx ON privilege_history (privilege_id, datetime);
+ANALYZE privilege_history;
@@ -0,0 +1,11 @@
+-- Replaces ticket_username_idx with (username, id), which also serves the
+-- ORDER BY id of paginated ticket lists. Safe to run repeatedly, run it
+-- outside of a transaction:
+--   psql -U program -h <host> -f postgres/migrations/002-ticket-username-id-index.sql
+
+\c tickets
+set role program;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_username_id_idx ON ticket (username, id);
+DROP INDEX CONCURRENTLY IF EXISTS ticket_username_idx;
+ANALYZE ticket;
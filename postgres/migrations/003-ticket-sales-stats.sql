@@ -0,0 +1,12 @@
+-- Adds ticket.created_at and the indexes behind GET /tickets/stats. Rows
+-- that existed before get the time of the migration as created_at. Safe to
+-- run repeatedly, run it outside of a transaction:
+--   psql -U program -h <host> -f postgres/migrations/003-ticket-sales-stats.sql
+
+\c tickets
+set role program;
+
+ALTER TABLE ticket ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now();
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_flight_status_idx ON ticket (flight_number, status, price);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ticket_created_at_idx ON ticket (created_at);
+ANALYZE ticket;
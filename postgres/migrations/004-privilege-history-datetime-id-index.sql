@@ -0,0 +1,12 @@
+-- Replaces privilege_history_datetime_idx with (privilege_id, datetime, id),
+-- which also serves the (datetime, id) keyset pagination and its tie-break
+-- in GET /privilege/{username}/summary. Safe to run repeatedly, run it
+-- outside of a transaction:
+--   psql -U program -h <host> -f postgres/migrations/004-privilege-history-datetime-id-index.sql
+
+\c privileges
+set role program;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS privilege_history_datetime_id_idx ON privilege_history (privilege_id, datetime, id);
+DROP INDEX CONCURRENTLY IF EXISTS privilege_history_datetime_idx;
+ANALYZE privilege_history;